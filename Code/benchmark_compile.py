@@ -0,0 +1,83 @@
+import argparse
+import json
+import time
+
+import torch
+import segmentation_models_pytorch as smp
+
+from bonyanatomy.compile import artifact_key, compile_model
+from bonyanatomy.epoch import autocast
+
+def setup_argparse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--encoders", nargs="+", default=["resnet18", "efficientnet-b0"], help="Encoder backbones for U-Net")
+    parser.add_argument("--modes", nargs="+", default=["eager", "compile", "script"], help="Execution modes to compare")
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--image_size", type=int, default=224)
+    parser.add_argument("--num_classes", type=int, default=5)
+    parser.add_argument("--steps", type=int, default=10, help="Steady-state steps timed after the warm-up")
+    parser.add_argument("--precision", default="fp32", help="fp32, bf16 or fp16")
+    parser.add_argument("--cache_dir", help="Compiled artifact cache; a second run shows the warm-cache overhead")
+    parser.add_argument("--out", help="JSON file for the results")
+    return parser
+
+def time_steps(step, steps):
+    start = time.perf_counter()
+    step()
+    first = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(steps):
+        step()
+    steady = (time.perf_counter() - start) / steps
+
+    # The first step pays compilation on top of an ordinary step
+    return {"steps_per_sec": 1 / steady, "first_step_seconds": first, "compile_overhead_seconds": max(0.0, first - steady)}
+
+def benchmark(encoder, mode, args):
+    torch.manual_seed(0)
+    model = smp.Unet(encoder_name=encoder, encoder_weights=None, in_channels=1, classes=args.num_classes)
+    optimizer = torch.optim.Adam(model.parameters(), lr=5e-04)
+    loss_fn = torch.nn.CrossEntropyLoss()
+    key = artifact_key(encoder, (1, args.image_size, args.image_size), args.precision)
+    compiled = compile_model(model, mode, args.cache_dir, key)
+
+    x = torch.rand(args.batch_size, 1, args.image_size, args.image_size) * 255
+    y = torch.randint(0, args.num_classes, (args.batch_size, args.image_size, args.image_size))
+
+    def train_step():
+        optimizer.zero_grad()
+        with autocast(args.precision, "cpu"):
+            loss = loss_fn(compiled(x), y)
+        loss.backward()
+        optimizer.step()
+
+    def eval_step():
+        with torch.inference_mode(), autocast(args.precision, "cpu"):
+            compiled(x)
+
+    compiled.train()
+    train = time_steps(train_step, args.steps)
+    compiled.eval()
+    evaluation = time_steps(eval_step, args.steps)
+    return {"train": train, "eval": evaluation, "mode": getattr(compiled, "mode", mode)}
+
+if __name__ == "__main__":
+    parser = setup_argparse()
+    args = parser.parse_args()
+
+    results = {}
+    print(f"{'encoder':<16} {'mode':<8} {'train steps/s':>14} {'overhead s':>11} {'eval steps/s':>13} {'overhead s':>11}")
+    for encoder in args.encoders:
+        for mode in args.modes:
+            result = benchmark(encoder, mode, args)
+            results[f"{encoder}/{mode}"] = result
+            train, evaluation = result["train"], result["eval"]
+            # A failed torch.compile reports the mode it fell back to
+            label = mode if result["mode"] == mode else f"{mode}->{result['mode']}"
+            print(f"{encoder:<16} {label:<8} {train['steps_per_sec']:>14.3f} {train['compile_overhead_seconds']:>11.1f} "
+                  f"{evaluation['steps_per_sec']:>13.3f} {evaluation['compile_overhead_seconds']:>11.1f}")
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=4)
@@ -0,0 +1,52 @@
+import argparse
+import time
+
+import pandas as pd
+from torch.utils.data import DataLoader
+
+from config import TrainingConfig
+from bonyanatomy.transforms import select_transforms
+
+def setup_argparse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("csv_file", help="Split CSV with the ids to load")
+    parser.add_argument("img_root", help="Root of the imaging data and annotations")
+    parser.add_argument("--batches", type=int, default=20, help="Number of batches to time for each backend")
+    parser.add_argument("--num_workers", type=int, default=0, help="DataLoader workers for both backends")
+    return parser
+
+def load_batches(config, ids, batches, num_workers):
+    transforms, collate_fn = select_transforms(config)
+    dataset = config.dataset(config.imaging_root, ids, transforms)
+    loader = DataLoader(dataset, batch_size=config.train_batch_size, collate_fn=collate_fn, num_workers=num_workers)
+
+    loaded = []
+    start = time.perf_counter()
+    for i, batch in enumerate(loader):
+        loaded.append(batch)
+        if i + 1 >= batches:
+            break
+    elapsed = time.perf_counter() - start
+
+    return loaded, sum(len(image) for image, _ in loaded) / elapsed
+
+if __name__ == "__main__":
+    parser = setup_argparse()
+    args = parser.parse_args()
+
+    config = TrainingConfig()
+    config.imaging_root = args.img_root
+    ids = pd.read_csv(args.csv_file).id
+
+    results = {}
+    for backend in ("albumentations", "torch"):
+        config.transform_backend = backend
+        results[backend] = load_batches(config, ids, args.batches, args.num_workers)
+        print(f"{backend}: {results[backend][1]:.1f} samples/sec")
+
+    image_diff, mask_mismatch = 0.0, 0.0
+    for (a_img, a_mask), (t_img, t_mask) in zip(results["albumentations"][0], results["torch"][0]):
+        image_diff = max(image_diff, (a_img - t_img).abs().max().item())
+        mask_mismatch = max(mask_mismatch, (a_mask != t_mask).float().mean().item())
+
+    print(f"Max image difference: {image_diff:.4f}, max fraction of mismatched mask pixels: {mask_mismatch:.6f}")
@@ -1,12 +1,27 @@
+import argparse
+import os
+
 import pandas as pd
 
-from bonyanatomy.pipeline import BiasEvaluationPipeline
+from bonyanatomy.pipeline import BiasEvaluationPipeline, BiasEvaluationSweep
+from bonyanatomy.manifest import exclude_invalid, manifest_path
 from bonyanatomy.labels import KneeAnatomy, HipAnatomy
 from config import ResNet18SexGroups, EfficientNetB0SexGroups, ResNet18RacialGroups, EfficientNetB0RacialGroups, ResNet18AgeGroups, EfficientNetB0AgeGroups
 
 
-data = pd.read_csv("/data_vault/hexai/ScientificReports_Hip_Knee_Datasets/Hip/Hip_segmentation.csv")
-data = data[~data.id.isin([9002116,9025994])].reset_index(drop=True)
+def setup_argparse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_root", help="Directory holding the splits generated by setup.py, read from hip/hip_segmentation.csv "
+                                          "so ids added by ingest.py are evaluated too")
+    return parser
+
+args = setup_argparse().parse_args()
+data = pd.read_csv(f"{args.data_root}/hip/hip_segmentation.csv")
+manifest_file = manifest_path("/data_vault/hexai/ScientificReports_Hip_Knee_Datasets/Hip/")
+data = exclude_invalid(data, manifest_file if os.path.exists(manifest_file) else None, fallback_ids=["9002116", "9025994"])
+
+# The configs are evaluated together, decoding each image once for all of their models
+pipelines = []
 
 #Sex Groups
 #RESNET
@@ -15,8 +30,7 @@ bias_sex_config = ResNet18SexGroups(anatomy="Hip")
 bias_sex_config.labels = HipAnatomy()
 bias_sex_config.imaging_root = "/data_vault/hexai/ScientificReports_Hip_Knee_Datasets/Hip/"
 bias_sex = BiasEvaluationPipeline(data, "FairnessSex_Resnet18_Hip", bias_sex_config)
-bias_sex.evaluate_bias()
-bias_sex.save("results_v2")
+pipelines.append((bias_sex, "results_v2"))
 
 # EFFICIENTNET
 print("Running Sex Eval. for EfficientNet-B0...")
@@ -24,8 +38,7 @@ bias_sex_config = EfficientNetB0SexGroups(anatomy="Hip")
 bias_sex_config.labels = HipAnatomy()
 bias_sex_config.imaging_root = "/data_vault/hexai/ScientificReports_Hip_Knee_Datasets/Hip/"
 bias_sex = BiasEvaluationPipeline(data, "FairnessSex_EfficientNetB0_Hip", bias_sex_config)
-bias_sex.evaluate_bias()
-bias_sex.save("results_v2/")
+pipelines.append((bias_sex, "results_v2/"))
 
 #Racial Groups
 #RESNET
@@ -35,8 +48,7 @@ bias_sex_config = ResNet18RacialGroups(anatomy="Hip")
 bias_sex_config.labels = HipAnatomy()
 bias_sex_config.imaging_root = "/data_vault/hexai/ScientificReports_Hip_Knee_Datasets/Hip/"
 bias_sex = BiasEvaluationPipeline(data, "FairnessRace_Resnet18_Hip", bias_sex_config)
-bias_sex.evaluate_bias()
-bias_sex.save("results_v2")
+pipelines.append((bias_sex, "results_v2"))
 
 # EFFICIENTNET
 print("Running Race Eval. for EfficientNet-B0...")
@@ -44,8 +56,7 @@ bias_sex_config = EfficientNetB0RacialGroups(anatomy="Hip")
 bias_sex_config.labels = HipAnatomy()
 bias_sex_config.imaging_root = "/data_vault/hexai/ScientificReports_Hip_Knee_Datasets/Hip/"
 bias_sex = BiasEvaluationPipeline(data, "FairnessRace_EfficientNetB0_Hip", bias_sex_config)
-bias_sex.evaluate_bias()
-bias_sex.save("results_v2/")
+pipelines.append((bias_sex, "results_v2/"))
 
 
 # Age Groups
@@ -55,8 +66,7 @@ bias_sex_config = ResNet18AgeGroups(anatomy="Hip")
 bias_sex_config.labels = HipAnatomy()
 bias_sex_config.imaging_root = "/data_vault/hexai/ScientificReports_Hip_Knee_Datasets/Hip/"
 bias_sex = BiasEvaluationPipeline(data, "FairnessAge_Resnet18_Hip", bias_sex_config)
-bias_sex.evaluate_bias()
-bias_sex.save("results_v2")
+pipelines.append((bias_sex, "results_v2"))
 
 # EFFICIENTNET
 print("Running Age Eval. for EfficientNet-B0...")
@@ -64,6 +74,8 @@ bias_sex_config = EfficientNetB0AgeGroups(anatomy="Hip")
 bias_sex_config.labels = HipAnatomy()
 bias_sex_config.imaging_root = "/data_vault/hexai/ScientificReports_Hip_Knee_Datasets/Hip/"
 bias_sex = BiasEvaluationPipeline(data, "FairnessAge_EfficientNetB0_Hip", bias_sex_config)
-bias_sex.evaluate_bias()
-bias_sex.save("results_v2/")
+pipelines.append((bias_sex, "results_v2/"))
 
+BiasEvaluationSweep([pipeline for pipeline, _ in pipelines]).run()
+for pipeline, path in pipelines:
+    pipeline.save(path)
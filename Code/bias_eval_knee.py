@@ -1,12 +1,27 @@
+import argparse
+import os
+
 import pandas as pd
 
-from bonyanatomy.pipeline import BiasEvaluationPipeline
+from bonyanatomy.pipeline import BiasEvaluationPipeline, BiasEvaluationSweep
+from bonyanatomy.manifest import exclude_invalid, manifest_path
 from bonyanatomy.labels import KneeAnatomy, HipAnatomy
 from config import ResNet18SexGroups, EfficientNetB0SexGroups, ResNet18RacialGroups, EfficientNetB0RacialGroups, ResNet18AgeGroups, EfficientNetB0AgeGroups
 
 
-data = pd.read_csv("/data_vault/hexai/ScientificReports_Hip_Knee_Datasets/Knee/Knee_segmentation.csv")
-data = data[data.id != 9025994].reset_index(drop=True)
+def setup_argparse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_root", help="Directory holding the splits generated by setup.py, read from knee/knee_segmentation.csv "
+                                          "so ids added by ingest.py are evaluated too")
+    return parser
+
+args = setup_argparse().parse_args()
+data = pd.read_csv(f"{args.data_root}/knee/knee_segmentation.csv")
+manifest_file = manifest_path("/data_vault/hexai/ScientificReports_Hip_Knee_Datasets/Knee/")
+data = exclude_invalid(data, manifest_file if os.path.exists(manifest_file) else None)
+
+# The configs are evaluated together, decoding each image once for all of their models
+pipelines = []
 
 # Sex Groups
 # RESNET
@@ -16,8 +31,7 @@ bias_sex_config.anatomy = "Knee"
 bias_sex_config.labels = KneeAnatomy()
 bias_sex_config.imaging_root = "/data_vault/hexai/ScientificReports_Hip_Knee_Datasets/Knee/"
 bias_sex = BiasEvaluationPipeline(data, "FairnessSex_Resnet18_Knee", bias_sex_config)
-bias_sex.evaluate_bias()
-bias_sex.save("results_v2")
+pipelines.append((bias_sex, "results_v2"))
 
 # EFFICIENTNET
 print("Running Sex Eval. for EfficientNet-B0...")
@@ -26,8 +40,7 @@ bias_sex_config.labels = KneeAnatomy()
 bias_sex_config.imaging_root = "/data_vault/hexai/ScientificReports_Hip_Knee_Datasets/Knee/"
 
 bias_sex = BiasEvaluationPipeline(data, "FairnessSex_EfficientNetB0_Knee", bias_sex_config)
-bias_sex.evaluate_bias()
-bias_sex.save("results_v2/")
+pipelines.append((bias_sex, "results_v2/"))
 
 # Racial Groups
 # RESNET
@@ -38,8 +51,7 @@ bias_sex_config.anatomy = "Knee"
 bias_sex_config.labels = KneeAnatomy()
 bias_sex_config.imaging_root = "/data_vault/hexai/ScientificReports_Hip_Knee_Datasets/Knee/"
 bias_sex = BiasEvaluationPipeline(data, "FairnessRace_Resnet18_Knee", bias_sex_config)
-bias_sex.evaluate_bias()
-bias_sex.save("results_v2")
+pipelines.append((bias_sex, "results_v2"))
 
 # EFFICIENTNET
 print("Running Race Eval. for EfficientNet-B0...")
@@ -48,8 +60,7 @@ bias_sex_config.labels = KneeAnatomy()
 bias_sex_config.imaging_root = "/data_vault/hexai/ScientificReports_Hip_Knee_Datasets/Knee/"
 
 bias_sex = BiasEvaluationPipeline(data, "FairnessRace_EfficientNetB0_Knee", bias_sex_config)
-bias_sex.evaluate_bias()
-bias_sex.save("results_v2/")
+pipelines.append((bias_sex, "results_v2/"))
 
 
 # Age Groups
@@ -60,8 +71,7 @@ bias_sex_config.anatomy = "Knee"
 bias_sex_config.labels = KneeAnatomy()
 bias_sex_config.imaging_root = "/data_vault/hexai/ScientificReports_Hip_Knee_Datasets/Knee/"
 bias_sex = BiasEvaluationPipeline(data, "FairnessAge_Resnet18_Knee", bias_sex_config)
-bias_sex.evaluate_bias()
-bias_sex.save("results_v2")
+pipelines.append((bias_sex, "results_v2"))
 
 # EFFICIENTNET
 print("Running Age Eval. for EfficientNet-B0...")
@@ -70,6 +80,8 @@ bias_sex_config.labels = KneeAnatomy()
 bias_sex_config.imaging_root = "/data_vault/hexai/ScientificReports_Hip_Knee_Datasets/Knee/"
 
 bias_sex = BiasEvaluationPipeline(data, "FairnessAge_EfficientNetB0_Knee", bias_sex_config)
-bias_sex.evaluate_bias()
-bias_sex.save("results_v2/")
+pipelines.append((bias_sex, "results_v2/"))
 
+BiasEvaluationSweep([pipeline for pipeline, _ in pipelines]).run()
+for pipeline, path in pipelines:
+    pipeline.save(path)
@@ -0,0 +1,24 @@
+import argparse
+
+from bonyanatomy.manifest import build_manifest, manifest_path
+
+def setup_argparse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("img_root", help="Root of the imaging data and annotations for one anatomy")
+    parser.add_argument("--out", help="Path of the manifest CSV, defaults to manifest.csv inside img_root")
+    parser.add_argument("--workers", type=int, default=32, help="Number of files scanned in parallel")
+    parser.add_argument("--no_hash", action="store_true", help="Skip hashing file contents")
+    return parser
+
+if __name__ == "__main__":
+    parser = setup_argparse()
+    args = parser.parse_args()
+
+    manifest = build_manifest(args.img_root, workers=args.workers, hash_contents=not args.no_hash)
+    out = args.out or manifest_path(args.img_root)
+    manifest.to_csv(out, index=False)
+
+    invalid = manifest[~manifest.valid]
+    print(f"Wrote manifest of {len(manifest)} ids to {out}, {len(invalid)} invalid")
+    for _, row in invalid.iterrows():
+        print(f"  {row.id}: {row.error}")
@@ -0,0 +1,24 @@
+import argparse
+
+import pandas as pd
+
+from bonyanatomy.cache import PyramidCache
+from bonyanatomy.dataset import BonyAnatomyJointSegmentationDataset
+from bonyanatomy.manifest import list_ids
+
+def setup_argparse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("img_root", help="Root of the imaging data and annotations")
+    parser.add_argument("outdir", help="Directory of the multi-resolution cache, extended in place if it exists")
+    parser.add_argument("--csv_file", help="CSV whose ids are cached, defaults to every id under img_root")
+    parser.add_argument("--levels", type=int, nargs="+", default=[128, 224, 384, 512], help="Square sizes to store")
+    return parser
+
+if __name__ == "__main__":
+    parser = setup_argparse()
+    args = parser.parse_args()
+
+    ids = pd.read_csv(args.csv_file).id if args.csv_file else list_ids(args.img_root)
+    dataset = BonyAnatomyJointSegmentationDataset(args.img_root, ids)
+    pyramid = PyramidCache.build(args.outdir, dataset, levels=args.levels)
+    print(f"{len(pyramid.index)} ids cached at sizes {pyramid.levels}")
@@ -0,0 +1,28 @@
+import argparse
+import glob
+import os
+
+import pandas as pd
+
+from bonyanatomy.dataset import BonyAnatomyJointSegmentationDataset
+from bonyanatomy.shards import write_shards
+
+def setup_argparse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("split_dir", help="Directory containing the split CSV files generated by setup.py")
+    parser.add_argument("img_root", help="Root of the imaging data and annotations for the same anatomy")
+    parser.add_argument("outdir", help="Directory to save the packed shards, one sub-directory per split CSV")
+    parser.add_argument("--shard_size", type=int, default=256, help="Number of samples per shard")
+    return parser
+
+if __name__ == "__main__":
+    parser = setup_argparse()
+    args = parser.parse_args()
+
+    for csv_file in sorted(glob.glob(f"{args.split_dir}/*.csv")):
+        split = os.path.splitext(os.path.basename(csv_file))[0]
+        records = pd.read_csv(csv_file)
+
+        print(f"Packing {split} ({len(records)} samples)")
+        dataset = BonyAnatomyJointSegmentationDataset(args.img_root, records.id)
+        write_shards(dataset, records, f"{args.outdir}/{split}", shard_size=args.shard_size)
@@ -4,12 +4,12 @@ from typing import Dict, Type
 
 from bonyanatomy.dataset import BonyAnatomyJointSegmentationDataset
 from bonyanatomy.bias_metrics import SkewedErrorRatio, StandardDeviation
+from bonyanatomy.loader import LoaderProfile
+from bonyanatomy.metrics import MulticlassJaccardIndex, Dice
 from dataclasses import dataclass, field
 
 import torch
 
-import torchmetrics
-
 @dataclass
 class TrainingConfig:
     epochs = 50
@@ -24,16 +24,72 @@ class TrainingConfig:
     activation = None
     in_channels = 1
     encoder_weights = "imagenet"
-    metrics = [torchmetrics.classification.MulticlassJaccardIndex, torchmetrics.classification.Dice]
+    metrics = [MulticlassJaccardIndex, Dice]
+    # "fp32", "bf16" (autocast) or "fp16" (autocast with a gradient scaler where supported)
+    precision = "fp32"
     transforms = A.Compose([A.Resize(image_size, image_size), ToTensorV2()])
+    # "albumentations" applies transforms per sample, "torch" resizes whole batches in the collate stage
+    transform_backend = "albumentations"
+    # Directory for the memory-mapped sample cache, None decodes every epoch
+    cache_dir = None
+    # Multi-resolution cache from build_pyramid.py, served at image_size
+    pyramid_dir = None
+    # Manifest CSV from build_manifest.py; split ids are validated against it at start-up
+    manifest = None
+    # Process-wide LRU of decoded samples shared by consecutive pipelines, in bytes (None disables)
+    shared_cache_budget = None
+    # MultiModelTrainingPipeline reads the shared train stream in split order, like a single run;
+    # True shuffles it, so the models no longer see the batches they would see trained alone
+    shared_shuffle = False
+    shared_cache_prefill = False
+    # Directory of packed shards from build_shards.py, used instead of imaging_root when set
+    shard_root = None
+    # DataLoader workers/prefetching; autotune benchmarks a grid on the train split instead
+    loader_profile = LoaderProfile()
+    loader_autotune = False
+    autotune_batches = 10
+    # Write save_dir/checkpoint.pt every N epochs (None disables); resume continues from it. The checkpoint
+    # is removed once the trained model is saved
+    checkpoint_every = 1
+    resume = False
+    # Stop after this many validations without a gain above min_delta (None trains all epochs)
+    early_stopping_patience = None
+    early_stopping_min_delta = 0.0
+    # Validate every N epochs; the last epoch is always validated
+    validate_every = 1
+    # Fraction of the validation split used until a full pass on the best model, stratified on the columns below
+    valid_subsample = None
+    valid_subsample_stratify_on = ["P02SEX", "P02RACE", "V00AGE_GROUP"]
+    # Freeze the encoder (kept in eval mode) and train only the decoder and segmentation head
+    freeze_encoder = False
+    # With a frozen encoder, cache per-image encoder features here ("fp16" or "bf16") and train the decoder from them
+    feature_cache_dir = None
+    feature_dtype = "fp16"
+    # None picks cuda when available; distributed training reads its rank from the torchrun environment
+    device = None
+    distributed = False
+    dist_backend = "gloo"
+    # Samples per optimizer step, accumulated over micro-batches (None steps every train_batch_size samples).
+    # The micro-batch size is micro_batch_size, or probed on the first batch to fit memory_budget bytes,
+    # otherwise train_batch_size
+    effective_batch_size = None
+    micro_batch_size = None
+    memory_budget = None
+    # "compile" (torch.compile, falling back to TorchScript) or "script" (TorchScript trace); None runs eagerly.
+    # compile_cache_dir keeps inductor artifacts per encoder, input shape and torch version
+    compile_mode = None
+    compile_cache_dir = None
+    # "safetensors" writes unet_<encoder>.safetensors (state dict plus metadata, memory-mapped on load),
+    # "pt" the legacy pickled model unet_<encoder>.pt
+    checkpoint_format = "safetensors"
 
     
 @dataclass
 class BiasEvalBaseConfig:
     dataset = BonyAnatomyJointSegmentationDataset
     eval_metrics: Dict[str, Type] = field(default_factory=lambda: {
-        "IoU": torchmetrics.classification.MulticlassJaccardIndex,
-        "Dice": torchmetrics.classification.Dice
+        "IoU": MulticlassJaccardIndex,
+        "Dice": Dice
     })
     bias_metrics: Dict[str, Type] = field(default_factory=lambda: {
         "SER": SkewedErrorRatio,
@@ -41,6 +97,32 @@ class BiasEvalBaseConfig:
     })
     image_size = 224
     transforms = A.Compose([A.Resize(image_size, image_size), ToTensorV2()])
+    transform_backend = "albumentations"
+    precision = "fp32"
+    # Re-run every group in fp32 and report the per-group IoU/Dice differences
+    precision_parity = False
+    precision_parity_tolerance = 0.005
+    cache_dir = None
+    pyramid_dir = None
+    manifest = None
+    loader_profile = LoaderProfile()
+    compile_mode = None
+    compile_cache_dir = None
+    # Defaults to cuda when available, otherwise cpu
+    device = None
+    eval_batch_size = 16
+    # Models a BiasEvaluationSweep keeps on the device at once, more are evaluated in further passes; None loads all
+    max_resident_models = 4
+    # SQLite file of per-image confusion matrices per checkpoint and transform; evaluation only runs
+    # images without stored predictions. store_masks also keeps the compressed argmax masks
+    prediction_store = None
+    store_masks = False
+    # Bootstrap confidence intervals and permutation p-values of the bias metrics and group gaps,
+    # resampling the per-image scores within each group; bootstrap_samples = None skips them
+    bootstrap_samples = 2000
+    permutation_samples = 2000
+    confidence_level = 0.95
+    bootstrap_seed = 0
 
     def __post_init__(self):
         self.bias_metrics = {
@@ -49,8 +131,8 @@ class BiasEvalBaseConfig:
         }
 
         self.eval_metrics =  {
-            "IoU": torchmetrics.classification.MulticlassJaccardIndex,
-            "Dice": torchmetrics.classification.Dice
+            "IoU": MulticlassJaccardIndex,
+            "Dice": Dice
          }
 
 class ResNet18SexGroups(BiasEvalBaseConfig):
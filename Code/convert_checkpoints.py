@@ -0,0 +1,38 @@
+import argparse
+import glob
+import os
+
+import torch
+
+from bonyanatomy.checkpoint import save_unet
+
+# Writes unet_<encoder>.safetensors next to every pickled unet_<encoder>.pt. The evaluation
+# pipeline picks up the .safetensors sibling of a configured .pt path automatically.
+
+def setup_argparse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", nargs="+", help="unet_*.pt files, or directories searched recursively for them")
+    parser.add_argument("--image_size", type=int, default=224, help="Input size the models were trained on, stored as metadata")
+    parser.add_argument("--overwrite", action="store_true", help="Convert even when the .safetensors file exists")
+    return parser
+
+def find_checkpoints(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            yield from sorted(glob.glob(os.path.join(path, "**", "unet_*.pt"), recursive=True))
+        else:
+            yield path
+
+if __name__ == "__main__":
+    parser = setup_argparse()
+    args = parser.parse_args()
+
+    for path in find_checkpoints(args.paths):
+        target = f"{os.path.splitext(path)[0]}.safetensors"
+        if os.path.exists(target) and not args.overwrite:
+            print("Skipping", path, "(already converted)")
+            continue
+
+        model = torch.load(path, map_location="cpu", weights_only=False)
+        save_unet(target, getattr(model, "module", model), args.image_size)
+        print(f"{path} -> {target} ({os.path.getsize(path) / 2**20:.1f} MB -> {os.path.getsize(target) / 2**20:.1f} MB)")
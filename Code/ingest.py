@@ -0,0 +1,108 @@
+import argparse
+import os
+
+import pandas as pd
+
+from setup import prepare_records, hash_split
+from bonyanatomy.cache import PyramidCache
+from bonyanatomy.dataset import BonyAnatomyJointSegmentationDataset
+from bonyanatomy.manifest import build_manifest, list_ids, load_manifest, manifest_path
+from bonyanatomy.shards import write_shards
+
+# Group-specific split files each demographic value is also appended to
+GROUP_SPLITS = {
+    "White_Caucasian": "white", "1: White or Caucasian": "white",
+    "Black_AfricanAmerican": "black", "2: Black or African American": "black",
+    "Male": "male", "1: Male": "male",
+    "Female": "female", "2: Female": "female",
+    "Age_50_Lower": "age_50_lower", 0: "age_50_lower",
+    "Age_51_64": "age_51_64", 1: "age_51_64",
+    "Age_65_79": "age_65_79", 2: "age_65_79"
+}
+
+def setup_argparse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("anatomy", help="Corresponding bony anatomy for demographic data")
+    parser.add_argument("csv_file", help="CSV file containing demographic information, including the new ids")
+    parser.add_argument("img_root", help="Root of the imaging data and annotations")
+    parser.add_argument("outdir", help="Directory holding the splits generated by setup.py")
+    parser.add_argument("--pyramid_dir", help="Multi-resolution cache to extend with the new ids")
+    parser.add_argument("--shard_root", help="Packed shards to re-pack for the split files that changed")
+    return parser
+
+def register_manifest(img_root):
+    path = manifest_path(img_root)
+    manifest = load_manifest(path) if os.path.exists(path) else pd.DataFrame(columns=["id", "valid"])
+
+    new_ids = sorted(set(list_ids(img_root)) - set(manifest.id))
+    if not new_ids:
+        return manifest, []
+
+    scanned = build_manifest(img_root, ids=new_ids)
+    manifest = pd.concat([manifest, scanned], ignore_index=True)
+
+    tmp = f"{path}.tmp"
+    manifest.to_csv(tmp, index=False)
+    os.replace(tmp, path)
+
+    print(f"Registered {len(new_ids)} new ids in {path}, {int((~scanned.valid).sum())} invalid")
+    return manifest, scanned.id[scanned.valid].tolist()
+
+def append_records(split_file, records):
+    existing = pd.read_csv(split_file, nrows=0)
+    records[existing.columns].to_csv(split_file, mode="a", header=False, index=False)
+
+if __name__ == "__main__":
+    parser = setup_argparse()
+    args = parser.parse_args()
+    anatomy = args.anatomy
+    outdir = f"{args.outdir}/{anatomy}"
+
+    manifest, new_ids = register_manifest(args.img_root)
+    if not new_ids:
+        print("No new ids to register")
+        raise SystemExit(0)
+
+    # Ids already in the splits keep their assignment, e.g. when the manifest is built for the first time
+    segmentation_file = f"{outdir}/{anatomy}_segmentation.csv"
+    if os.path.exists(segmentation_file):
+        registered = set(pd.read_csv(segmentation_file).id.astype(str))
+        new_ids = [pid for pid in new_ids if pid not in registered]
+
+    data_records = pd.read_csv(args.csv_file)
+    data_records = data_records[["id", "P02SEX", "P02RACE", "V00AGE"]]
+    data_records = data_records[data_records.id.astype(str).isin(new_ids)].reset_index(drop=True)
+    new_records = prepare_records(data_records)
+    missing = len(new_ids) - len(new_records)
+    if missing:
+        print(f"{missing} new ids have no demographic record and are left out of the splits")
+
+    new_records["split"] = new_records.id.map(hash_split)
+
+    changed = {segmentation_file: new_records.drop(columns="split")}
+    for split, records in new_records.groupby("split"):
+        records = records.drop(columns="split")
+        changed[f"{outdir}/{anatomy}_{split}_all.csv"] = records
+
+        for column in ("P02RACE", "P02SEX", "V00AGE_GROUP"):
+            for value, group in records.groupby(column):
+                if value in GROUP_SPLITS:
+                    changed[f"{outdir}/{anatomy}_{split}_{GROUP_SPLITS[value]}.csv"] = group
+
+    for split_file, records in changed.items():
+        if not os.path.exists(split_file):
+            continue
+        append_records(split_file, records)
+        print(f"Appended {len(records)} records to {split_file}")
+
+    if args.pyramid_dir:
+        dataset = BonyAnatomyJointSegmentationDataset(args.img_root, new_records.id)
+        PyramidCache.build(args.pyramid_dir, dataset)
+
+    if args.shard_root:
+        for split_file in changed:
+            split = os.path.splitext(os.path.basename(split_file))[0]
+            if os.path.exists(split_file) and os.path.isdir(f"{args.shard_root}/{split}"):
+                records = pd.read_csv(split_file)
+                dataset = BonyAnatomyJointSegmentationDataset(args.img_root, records.id)
+                write_shards(dataset, records, f"{args.shard_root}/{split}")
@@ -0,0 +1,141 @@
+import argparse
+
+from config import TrainingConfig
+from bonyanatomy.pipeline import TrainingPipeline, MultiModelTrainingPipeline
+from bonyanatomy.dataset import StratifiedSampler
+from bonyanatomy.labels import KneeAnatomy, HipAnatomy
+from bonyanatomy.scheduler import Job, run_jobs, print_summary
+
+ANATOMIES = {"Knee": KneeAnatomy, "Hip": HipAnatomy}
+STRATEGIES = ["baseline", "balanced", "stratified", "group"]
+
+# Attribute name used in run names, split file suffix for balanced sets, and stratification column
+ATTRIBUTES = {
+    "Gender": ("gender", "P02SEX"),
+    "Race": ("race", "P02RACE"),
+    "Age": ("age", "V00AGE_GROUP")
+}
+
+# Group-specific runs, as in group_specific_*.py: run name part and split file suffix
+GROUPS = {
+    "SexGroup": [("Male", "male"), ("Female", "female")],
+    "RaceGroup": [("White", "white"), ("Black", "black")],
+    "AgeGroup": [("50_Lower", "age_50_lower"), ("51_64", "age_51_64"), ("65_79", "age_65_79")]
+}
+
+# The hip age groups are too small to train on and are left out, as in group_specific_age.py
+SKIP_GROUPS = {("Hip", "AgeGroup")}
+
+def setup_argparse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_root", help="Directory with the splits generated by setup.py")
+    parser.add_argument("img_root", help="Root of the imaging data and annotations")
+    parser.add_argument("outdir", help="Directory to save the trained models")
+    parser.add_argument("--encoders", nargs="+", default=["resnet18", "efficientnet-b0"], help="Encoder backbones for U-Net")
+    parser.add_argument("--anatomies", nargs="+", default=list(ANATOMIES), choices=list(ANATOMIES))
+    parser.add_argument("--strategies", nargs="+", default=STRATEGIES, choices=STRATEGIES)
+    parser.add_argument("--cores_per_job", type=int, default=4, help="CPU cores (torch threads) per job")
+    parser.add_argument("--memory_per_job", type=float, default=8, help="Memory budget per job in GB")
+    parser.add_argument("--max_cores", type=int, help="Cores to divide among jobs, all by default")
+    parser.add_argument("--max_memory", type=float, help="Memory in GB to divide among jobs, all by default")
+    parser.add_argument("--gpus", nargs="+", help="GPU ids, one job runs on each at a time")
+    parser.add_argument("--retries", type=int, default=1, help="Times a failed job is retried")
+    parser.add_argument("--log_dir", help="Per-job logs and summary.json, outdir/logs by default")
+    parser.add_argument("--shared", action="store_true", help="Train the runs of each anatomy and encoder that need no stratified sampler from one data pass")
+    parser.add_argument("--dry_run", action="store_true", help="List the runs without starting them")
+    return parser
+
+def make_config(anatomy, encoder, train_set, valid_set, test_set, img_root, outdir, resume=False):
+    config = TrainingConfig()
+    config.labels = ANATOMIES[anatomy]()
+    config.encoder_backbone = encoder
+    config.train_set = train_set
+    config.valid_set = valid_set
+    config.test_set = test_set
+    config.imaging_root = f"{img_root}/{anatomy}/"
+    config.outdir = outdir
+    config.resume = resume
+    return config
+
+def train(name, stratify_on=None, resume=False, **kwargs):
+    config = make_config(resume=resume, **kwargs)
+    sampler = StratifiedSampler if stratify_on is not None else None
+    pipeline = TrainingPipeline(name, config, sampler, stratify_on)
+    pipeline.run()
+    pipeline.save()
+
+def train_shared(runs, resume=False):
+    pipeline = MultiModelTrainingPipeline([(name, make_config(resume=resume, **kwargs)) for name, kwargs in runs])
+    pipeline.run()
+    pipeline.save()
+
+def build_jobs(runs, args):
+    # Retries continue from the checkpoint the failed attempt left instead of starting at epoch 0
+    cores, memory, retry = args.cores_per_job, int(args.memory_per_job * 2**30), {"resume": True}
+    if not args.shared:
+        return [Job(name, train, args=(name,), kwargs=kwargs, cores=cores, memory=memory, retry_kwargs=retry) for name, kwargs in runs]
+
+    # Runs without a stratified sampler on the same anatomy and encoder share one data pass
+    jobs, groups = [], {}
+    for name, kwargs in runs:
+        if kwargs["stratify_on"] is not None:
+            jobs.append(Job(name, train, args=(name,), kwargs=kwargs, cores=cores, memory=memory, retry_kwargs=retry))
+        else:
+            groups.setdefault((kwargs["anatomy"], kwargs["encoder"]), []).append((name, {k: v for k, v in kwargs.items() if k != "stratify_on"}))
+
+    for (anatomy, encoder), group in groups.items():
+        jobs.append(Job(f"{anatomy}Shared_{encoder}", train_shared, args=(group,), cores=cores, memory=memory, retry_kwargs=retry))
+    return jobs
+
+def build_runs(args):
+    """Return (name, kwargs for train) for every run in the matrix, with the names used by the individual scripts."""
+    runs = []
+    for encoder in args.encoders:
+        for anatomy in args.anatomies:
+            splits = f"{args.data_root}/{anatomy.lower()}/{anatomy.lower()}"
+
+            def add(name, train_set, valid_set, test_set, stratify_on=None):
+                runs.append((f"{anatomy}{name}_{encoder}", {
+                    "anatomy": anatomy, "encoder": encoder, "train_set": train_set, "valid_set": valid_set,
+                    "test_set": test_set, "img_root": args.img_root, "outdir": args.outdir, "stratify_on": stratify_on
+                }))
+
+            if "baseline" in args.strategies:
+                add("Baseline", f"{splits}_train_all.csv", f"{splits}_valid_all.csv", f"{splits}_test_all.csv")
+
+            for attribute, (suffix, column) in ATTRIBUTES.items():
+                if "balanced" in args.strategies:
+                    add(f"Balanced_{attribute}", f"{splits}_{suffix}_balanced.csv", f"{splits}_valid_all.csv", f"{splits}_test_all.csv")
+                if "stratified" in args.strategies:
+                    add(f"Stratified_{attribute}", f"{splits}_train_all.csv", f"{splits}_valid_all.csv", f"{splits}_test_all.csv", column)
+
+            if "group" in args.strategies:
+                for attribute, groups in GROUPS.items():
+                    if (anatomy, attribute) in SKIP_GROUPS:
+                        continue
+                    for group, suffix in groups:
+                        add(f"Baseline_{attribute}_{group}", f"{splits}_train_{suffix}.csv", f"{splits}_valid_{suffix}.csv", f"{splits}_test_{suffix}.csv")
+
+    return runs
+
+if __name__ == "__main__":
+    parser = setup_argparse()
+    args = parser.parse_args()
+
+    runs = build_runs(args)
+    jobs = build_jobs(runs, args)
+    if args.dry_run:
+        for job in jobs:
+            print(job.name, *(name for name, _ in job.args[0]) if job.target is train_shared else ())
+        print(f"{len(runs)} runs in {len(jobs)} jobs")
+        raise SystemExit(0)
+
+    summary = run_jobs(
+        jobs,
+        args.log_dir or f"{args.outdir}/logs",
+        max_cores=args.max_cores,
+        max_memory=int(args.max_memory * 2**30) if args.max_memory else None,
+        gpus=args.gpus,
+        retries=args.retries
+    )
+    print_summary(summary)
@@ -1,4 +1,5 @@
 import argparse
+import hashlib
 
 import numpy as np
 import pandas as pd
@@ -7,11 +8,15 @@ import os
 
 from sklearn.model_selection import train_test_split
 
+from bonyanatomy.manifest import exclude_invalid
+
 def setup_argparse():
     parser = argparse.ArgumentParser()
     parser.add_argument("anatomy", help="Corresponding bony anatomy for demographic data")
     parser.add_argument("csv_file", help="CSV file containing demographic information for given bony anatomy")
     parser.add_argument("outdir", help="Directory to save training, validation, and testing splits for experimentations")
+    parser.add_argument("--manifest", help="Manifest CSV from build_manifest.py, ids it marks invalid are excluded from every split. "
+                                           "Without it only the known invalid study 9025994 is excluded")
     return parser
 
 def generate_age_grouping(dataset):
@@ -28,8 +33,32 @@ def generate_age_grouping(dataset):
     dataset_w_age["V00AGE_GROUP"] = np.where((dataset.V00AGE > 64) & (dataset.V00AGE <= 79), 2, dataset_w_age["V00AGE_GROUP"])
     return dataset_w_age
 
+def prepare_records(data_records):
+    data_records_w_age_group = generate_age_grouping(data_records)
+
+    data_records_w_age_group.replace({"1: White or Caucasian": "White_Caucasian",
+             "2: Black or African American": "Black_AfricanAmerican",
+             "1: Male": "Male",
+             "2: Female": "Female"}, inplace=True)
+    
+    data_records_w_age_group["V00AGE_GROUP"].replace({
+        0: "Age_50_Lower",
+        1: "Age_51_64",
+        2: "Age_65_79"
+    }, inplace=True)
+
+    return data_records_w_age_group
+
+def hash_split(pid):
+    # Deterministic 70/15/15 assignment for ids registered after the initial split
+    bucket = int(hashlib.sha1(str(pid).encode()).hexdigest(), 16) % 100
+    if bucket < 70:
+        return "train"
+    if bucket < 85:
+        return "valid"
+    return "test"
+
 def generate_train_test_split(data_records, filter_query=None):
-    data_records = data_records[data_records.id != 9025994].reset_index(drop=True)
     if filter_query:
         data_records = data_records.query(filter_query)
 
@@ -69,20 +98,12 @@ if __name__ == "__main__":
 
     data_records = pd.read_csv(csv_filename)
     data_records = data_records[["id", "P02SEX", "P02RACE", "V00AGE"]]
-    data_records_w_age_group = generate_age_grouping(data_records)
 
-    data_records_w_age_group.replace({"1: White or Caucasian": "White_Caucasian",
-             "2: Black or African American": "Black_AfricanAmerican",
-             "1: Male": "Male",
-             "2: Female": "Female"}, inplace=True)
-    
-    data_records_w_age_group["V00AGE_GROUP"].replace({
-        0: "Age_50_Lower",
-        1: "Age_51_64",
-        2: "Age_65_79"
-    }, inplace=True)
+    num_records = len(data_records)
+    data_records = exclude_invalid(data_records, args.manifest)
+    print(f"Excluded {num_records - len(data_records)} records without valid imaging data")
 
-    data_records_w_age_group.to_csv(f"/data_vault/hexai/ScientificReports_Hip_Knee_Datasets/{anatomy}/{anatomy}_segmentation.csv", index=False)
+    data_records_w_age_group = prepare_records(data_records)
 
     train_all, valid_all, test_all = generate_train_test_split(data_records_w_age_group)
     train_white, valid_white, test_white = generate_train_test_split(data_records_w_age_group, filter_query="P02RACE == '1: White or Caucasian'")
@@ -101,6 +122,8 @@ if __name__ == "__main__":
     outdir = f"{outdir}/{anatomy}"
     os.makedirs(outdir, exist_ok=True)
 
+    data_records_w_age_group.to_csv(f"{outdir}/{anatomy}_segmentation.csv", index=False)
+
     # Save Baseline splits
     train_all.to_csv(f"{outdir}/{anatomy}_train_all.csv", index=False)
     valid_all.to_csv(f"{outdir}/{anatomy}_valid_all.csv", index=False)
@@ -0,0 +1,46 @@
+import argparse
+
+import torch.distributed as dist
+
+from run_matrix import ANATOMIES, STRATEGIES, build_runs, make_config
+from bonyanatomy.pipeline import TrainingPipeline
+from bonyanatomy.dataset import StratifiedSampler
+
+# Launch one process per rank with torchrun, e.g. four local processes:
+#   torchrun --nproc_per_node 4 train_distributed.py KneeStratified_Race_resnet18 <data_root> <img_root> <outdir>
+# or several nodes with --nnodes/--node_rank/--rdzv_endpoint.
+
+def setup_argparse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("run", help="Run name as used by the training scripts, e.g. KneeBalanced_Race_resnet18")
+    parser.add_argument("data_root", help="Directory with the splits generated by setup.py")
+    parser.add_argument("img_root", help="Root of the imaging data and annotations")
+    parser.add_argument("outdir", help="Directory to save the trained model")
+    parser.add_argument("--backend", default="gloo", help="torch.distributed backend")
+    parser.add_argument("--epochs", type=int, help="Override the configured number of epochs")
+    return parser
+
+if __name__ == "__main__":
+    parser = setup_argparse()
+    args = parser.parse_args()
+
+    matrix_args = argparse.Namespace(data_root=args.data_root, img_root=args.img_root, outdir=args.outdir,
+                                     encoders=[args.run.rsplit("_", 1)[-1]], anatomies=list(ANATOMIES), strategies=STRATEGIES)
+    runs = dict(build_runs(matrix_args))
+    if args.run not in runs:
+        parser.error(f"Unknown run {args.run}, see run_matrix.py --dry_run for the run names")
+
+    kwargs = dict(runs[args.run])
+    stratify_on = kwargs.pop("stratify_on")
+    config = make_config(**kwargs)
+    config.distributed = True
+    config.dist_backend = args.backend
+    if args.epochs is not None:
+        config.epochs = args.epochs
+
+    pipeline = TrainingPipeline(args.run, config, StratifiedSampler if stratify_on is not None else None, stratify_on)
+    pipeline.run()
+    pipeline.save()
+
+    if dist.is_initialized():
+        dist.destroy_process_group()
@@ -1,14 +1,89 @@
+import itertools
+
 import numpy as np
 
+# Score the bias metrics on many resampled group means at once, along the last axis
 class SkewedErrorRatio:
     def compute(self, scores):
         scores = 1 - scores
 
-        max_score = np.max(scores)
-        min_score = np.min(scores)
+        max_score = np.max(scores, axis=-1)
+        min_score = np.min(scores, axis=-1)
 
         return  max_score/min_score
 
 class StandardDeviation:
     def compute(self, scores):
-        return np.std(scores)
\ No newline at end of file
+        return np.std(scores, axis=-1)
+
+
+def chunks(samples, n, max_elements=1 << 24):
+    # Resamples are drawn in blocks that keep the (block, n) index arrays bounded
+    size = max(1, max_elements // max(n, 1))
+    for start in range(0, samples, size):
+        yield min(size, samples - start)
+
+
+def bootstrap_means(groups, samples, rng):
+    """(samples, groups) means of each group's scores resampled with replacement within the group."""
+    means = np.empty((samples, len(groups)))
+    for g, scores in enumerate(groups):
+        start = 0
+        for size in chunks(samples, len(scores)):
+            means[start:start + size, g] = scores[rng.integers(0, len(scores), size=(size, len(scores)))].mean(axis=1)
+            start += size
+    return means
+
+
+def permutation_means(groups, samples, rng):
+    """(samples, groups) means after randomly reassigning the pooled scores to groups of the same sizes."""
+    pooled = np.concatenate(groups)
+    sizes = np.array([len(scores) for scores in groups])
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+
+    means = np.empty((samples, len(groups)))
+    start = 0
+    for size in chunks(samples, len(pooled)):
+        shuffled = pooled[np.argsort(rng.random((size, len(pooled))), axis=1)]
+        means[start:start + size] = np.add.reduceat(shuffled, starts, axis=1) / sizes
+        start += size
+    return means
+
+
+def bias_uncertainty(group_scores, bias_metrics, samples=2000, permutations=2000, confidence=0.95, seed=0):
+    """
+    Bootstrap confidence intervals and permutation p-values of the bias metrics
+    and of the pairwise gaps between group means. ``group_scores`` maps each
+    group to its per-image scores. Intervals are percentile intervals over
+    ``samples`` resamples within each group; p-values test the hypothesis that
+    group membership does not matter, one-sided for the bias metrics and
+    two-sided for the gaps. Every call starts from ``seed``, so results are
+    reproducible and models evaluated on the same groups share the resamples.
+    """
+    names = list(group_scores)
+    groups = [np.asarray(group_scores[name], dtype=np.float64) for name in names]
+    observed = np.array([scores.mean() for scores in groups])
+
+    rng = np.random.default_rng(seed)
+    boot = bootstrap_means(groups, samples, rng)
+    null = permutation_means(groups, permutations, rng)
+    tails = [(1 - confidence) / 2, 1 - (1 - confidence) / 2]
+
+    def interval(key, values):
+        low, high = np.quantile(values, tails)
+        return {f"{key}_ci_low": float(low), f"{key}_ci_high": float(high)}
+
+    def p_value(null_values, value):
+        return float((1 + np.count_nonzero(null_values >= value)) / (1 + len(null_values)))
+
+    results = {}
+    for name, metric in bias_metrics.items():
+        results.update(interval(name, metric.compute(boot)))
+        results[f"{name}_p"] = p_value(metric.compute(null), metric.compute(observed))
+
+    for i, j in itertools.combinations(range(len(names)), 2):
+        key = f"gap_{names[i]}-{names[j]}"
+        results[key] = float(observed[i] - observed[j])
+        results.update(interval(key, boot[:, i] - boot[:, j]))
+        results[f"{key}_p"] = p_value(np.abs(null[:, i] - null[:, j]), abs(observed[i] - observed[j]))
+    return results
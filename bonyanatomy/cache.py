@@ -0,0 +1,307 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+import torch
+
+
+def to_numpy(value):
+    if isinstance(value, torch.Tensor):
+        return value.numpy()
+    return np.asarray(value)
+
+
+# Part of the cache directory name, bumped when the stored layout changes so older caches are rebuilt
+CACHE_FORMAT = 2
+
+
+def source_fingerprint(dataset, pid):
+    # Changes whenever the radiograph or its annotation is rewritten
+    return f"{dataset.storage.mtime(dataset.get_image_path(pid))}:{dataset.storage.mtime(dataset.get_annotation_path(pid))}"
+
+
+def cache_key(dataset):
+    h = hashlib.sha1()
+    h.update(str(dataset.root_dir).encode())
+    h.update(repr(dataset.transforms).encode())
+    for pid in sorted(set(str(pid) for pid in dataset.pids)):
+        h.update(f"{pid}:{source_fingerprint(dataset, pid)};".encode())
+
+    # Pyramid samples are resized from the stored levels, so they differ from decoded ones
+    if dataset.pyramid is not None:
+        h.update(f"pyramid={os.path.abspath(dataset.pyramid.path)}:{dataset.image_size}:{dataset.pyramid.levels};".encode())
+        for pid in sorted(set(str(pid) for pid in dataset.pids)):
+            h.update(f"{pid}:{pid in dataset.pyramid};".encode())
+    return h.hexdigest()
+
+
+class MemmapSampleCache:
+    """
+    Fixed-shape, memory-mapped store of decoded and transformed samples.
+
+    Images and masks are stored in the dtype the transforms return, so cached
+    samples equal uncached ones, in one ``.npy`` file each, with ``index.json``
+    mapping every id to its row. The directory name is a hash of the imaging
+    root, the transform pipeline, the source file mtimes and any pyramid the
+    samples were read from, so any change to those produces a fresh cache.
+    Files are mapped copy-on-write and never written after the build, so
+    DataLoader workers and other pipelines can share a cache directory.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "index.json")) as f:
+            self.index = json.load(f)["ids"]
+        self._images = None
+        self._masks = None
+
+    @classmethod
+    def build(cls, cache_dir, dataset):
+        path = os.path.join(cache_dir, f"{cache_key(dataset)}-v{CACHE_FORMAT}")
+        if os.path.exists(os.path.join(path, "index.json")):
+            return cls(path)
+
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix=".building-", dir=cache_dir)
+        ids = sorted(set(str(pid) for pid in dataset.pids))
+
+        print(f"Building sample cache for {len(ids)} ids in {path}")
+        images, masks = None, None
+        for offset, pid in enumerate(ids):
+            image, mask = dataset.transform(*dataset.load_sample(pid))
+            image, mask = to_numpy(image), to_numpy(mask)
+
+            if images is None:
+                images = np.lib.format.open_memmap(os.path.join(tmp, "images.npy"), mode="w+",
+                                                   dtype=image.dtype, shape=(len(ids),) + image.shape)
+                masks = np.lib.format.open_memmap(os.path.join(tmp, "masks.npy"), mode="w+",
+                                                  dtype=mask.dtype, shape=(len(ids),) + mask.shape)
+
+            images[offset] = image
+            masks[offset] = mask
+
+        if images is not None:
+            images.flush()
+            masks.flush()
+        del images, masks
+
+        with open(os.path.join(tmp, "index.json"), "w") as f:
+            json.dump({"ids": {pid: offset for offset, pid in enumerate(ids)},
+                       "transforms": repr(dataset.transforms)}, f)
+
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # Another process finished building the same cache first
+            shutil.rmtree(tmp, ignore_errors=True)
+
+        return cls(path)
+
+    def open(self):
+        if self._images is None:
+            # Copy-on-write, so rows can back tensors directly and in-place edits stay private
+            self._images = np.load(os.path.join(self.path, "images.npy"), mmap_mode="c")
+            self._masks = np.load(os.path.join(self.path, "masks.npy"), mmap_mode="c")
+
+    def __getstate__(self):
+        # Each process maps the files itself instead of pickling the arrays
+        state = self.__dict__.copy()
+        state["_images"] = None
+        state["_masks"] = None
+        return state
+
+    def __contains__(self, pid):
+        return str(pid) in self.index
+
+    def __getitem__(self, pid):
+        self.open()
+        offset = self.index[str(pid)]
+        return self._images[offset], self._masks[offset]
+
+
+class SharedSampleCache:
+    """
+    Size-bounded LRU of decoded (image, mask) pairs keyed by (imaging root, id).
+
+    One instance, ``shared_sample_cache``, is used by every dataset in the
+    process, so consecutive pipelines over the same imaging root reuse each
+    other's decodes. DataLoader workers get a copy of the cache as it was when
+    they were forked, so prefill before iterating when loading with workers.
+    """
+    def __init__(self, budget_bytes=0):
+        self.budget_bytes = budget_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def resize(self, budget_bytes):
+        with self._lock:
+            self.budget_bytes = budget_bytes
+            self._evict()
+
+    def _evict(self):
+        while self.nbytes > self.budget_bytes and self._entries:
+            _, (image, mask) = self._entries.popitem(last=False)
+            self.nbytes -= image.nbytes + mask.nbytes
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, image, mask):
+        size = image.nbytes + mask.nbytes
+        with self._lock:
+            if key in self._entries or size > self.budget_bytes:
+                return
+
+            self._entries[key] = (image, mask)
+            self.nbytes += size
+            self._evict()
+
+    def load(self, dataset, pid):
+        key = (str(dataset.root_dir), str(pid))
+        entry = self.get(key)
+        if entry is None:
+            entry = dataset.decode_sample(pid)
+            self.put(key, *entry)
+        return entry
+
+    def prefill(self, dataset, ids=None):
+        ids = dataset.pids if ids is None else ids
+
+        def fill():
+            for pid in ids:
+                key = (str(dataset.root_dir), str(pid))
+                with self._lock:
+                    cached = key in self._entries
+                if not cached:
+                    self.put(key, *dataset.decode_sample(pid))
+
+        thread = threading.Thread(target=fill, daemon=True)
+        thread.start()
+        return thread
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "nbytes": self.nbytes, "budget_bytes": self.budget_bytes,
+                    "hits": self.hits, "misses": self.misses}
+
+
+shared_sample_cache = SharedSampleCache()
+
+
+class PyramidCache:
+    """
+    Radiographs and masks stored at several square resolutions in one artifact.
+
+    Every part directory holds ``images_<size>.npy`` and ``masks_<size>.npy`` for
+    each level, and ``index.json`` lists the levels and the ids of every part.
+    New ids are added as new parts, so existing parts are never rewritten.
+    Sizes without a stored level are downsampled from the nearest larger one.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "index.json")) as f:
+            index = json.load(f)
+
+        self.levels = sorted(index["levels"])
+        self.parts = index["parts"]
+        self.index = {pid: (p, row) for p, part in enumerate(self.parts) for row, pid in enumerate(part["ids"])}
+        self._arrays = {}
+
+    @classmethod
+    def build(cls, path, dataset, ids=None, levels=(128, 224, 384, 512)):
+        parts = []
+        if os.path.exists(os.path.join(path, "index.json")):
+            existing = cls(path)
+            levels, parts = existing.levels, existing.parts
+            cached = set(existing.index)
+        else:
+            os.makedirs(path, exist_ok=True)
+            cached = set()
+
+        ids = dataset.pids if ids is None else ids
+        new_ids = [pid for pid in dict.fromkeys(str(pid) for pid in ids) if pid not in cached]
+        if new_ids:
+            parts = parts + [cls.write_part(path, dataset, new_ids, sorted(levels), len(parts))]
+
+            tmp = os.path.join(path, f".index-{os.getpid()}.json")
+            with open(tmp, "w") as f:
+                json.dump({"levels": sorted(levels), "parts": parts}, f)
+            os.replace(tmp, os.path.join(path, "index.json"))
+
+        return cls(path)
+
+    @staticmethod
+    def write_part(path, dataset, ids, levels, number):
+        name = f"part-{number:05d}"
+        tmp = tempfile.mkdtemp(prefix=f".{name}-", dir=path)
+        print(f"Building {len(ids)} ids at sizes {levels} in {path}/{name}")
+
+        images, masks = {}, {}
+        for row, pid in enumerate(ids):
+            image, mask = dataset.decode_sample(pid)
+            for size in levels:
+                if size not in images:
+                    images[size] = np.lib.format.open_memmap(os.path.join(tmp, f"images_{size}.npy"), mode="w+",
+                                                             dtype=image.dtype, shape=(len(ids), size, size))
+                    masks[size] = np.lib.format.open_memmap(os.path.join(tmp, f"masks_{size}.npy"), mode="w+",
+                                                            dtype=np.uint8, shape=(len(ids), size, size))
+
+                resized = cv2.resize(image.astype(np.float32), (size, size), interpolation=cv2.INTER_LINEAR)
+                if np.issubdtype(image.dtype, np.integer):
+                    info = np.iinfo(image.dtype)
+                    resized = np.clip(np.rint(resized), info.min, info.max)
+                images[size][row] = resized
+                masks[size][row] = cv2.resize(mask, (size, size), interpolation=cv2.INTER_NEAREST)
+
+        for size in levels:
+            images[size].flush()
+            masks[size].flush()
+        del images, masks
+
+        os.rename(tmp, os.path.join(path, name))
+        return {"name": name, "ids": ids}
+
+    def level(self, part, kind, size):
+        key = (part, kind, size)
+        if key not in self._arrays:
+            self._arrays[key] = np.load(os.path.join(self.path, self.parts[part]["name"], f"{kind}_{size}.npy"), mmap_mode="r")
+        return self._arrays[key]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_arrays"] = {}
+        return state
+
+    def __contains__(self, pid):
+        return str(pid) in self.index
+
+    def load(self, pid, size):
+        larger = [level for level in self.levels if level >= size]
+        if not larger:
+            return None
+
+        part, row = self.index[str(pid)]
+        image = self.level(part, "images", larger[0])[row]
+        mask = self.level(part, "masks", larger[0])[row]
+
+        if larger[0] != size:
+            image = cv2.resize(image.astype(np.float32), (size, size), interpolation=cv2.INTER_AREA)
+            mask = cv2.resize(np.ascontiguousarray(mask), (size, size), interpolation=cv2.INTER_NEAREST)
+
+        return image, mask
@@ -0,0 +1,193 @@
+import os
+import json
+import random
+import struct
+
+import numpy as np
+import torch
+import segmentation_models_pytorch as smp
+
+
+class StateSnapshot:
+    """
+    CPU copy of a model's state_dict, kept in buffers that are reused between
+    captures. Copies from a GPU go to pinned memory without blocking, so
+    training carries on while they complete; ``get`` waits for them.
+    """
+    def __init__(self):
+        self.state = None
+        self._event = None
+
+    def capture(self, model):
+        state = model.state_dict()
+        if self.state is None:
+            self.state = {
+                k: torch.empty(v.shape, dtype=v.dtype, device="cpu", pin_memory=v.is_cuda) for k, v in state.items()
+            }
+
+        for k, v in state.items():
+            self.state[k].copy_(v.detach(), non_blocking=True)
+
+        self._event = None
+        if any(v.is_cuda for v in state.values()):
+            self._event = torch.cuda.Event()
+            self._event.record()
+
+    def load(self, state):
+        self.state = {k: v.clone() for k, v in state.items()}
+        self._event = None
+
+    def get(self):
+        if self._event is not None:
+            self._event.synchronize()
+        return self.state
+
+
+def capture_rng_state():
+    return {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else []
+    }
+
+
+def restore_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if state["cuda"] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def save_training_checkpoint(path, state):
+    # Write next to the target and rename, so a crash never leaves a truncated checkpoint
+    tmp = f"{path}.tmp"
+    torch.save(state, tmp)
+    os.replace(tmp, path)
+
+
+def load_training_checkpoint(path):
+    # Our own checkpoints hold optimizer and RNG state, which need full unpickling
+    return torch.load(path, map_location="cpu", weights_only=False)
+
+
+# safetensors dtype names; the layout is readable by the safetensors library but does not need it
+SAFETENSORS_DTYPES = {
+    torch.float64: "F64", torch.float32: "F32", torch.float16: "F16", torch.bfloat16: "BF16",
+    torch.int64: "I64", torch.int32: "I32", torch.int16: "I16", torch.int8: "I8",
+    torch.uint8: "U8", torch.bool: "BOOL"
+}
+TORCH_DTYPES = {name: dtype for dtype, name in SAFETENSORS_DTYPES.items()}
+
+ACTIVATIONS = {torch.nn.Identity: None, torch.nn.Sigmoid: "sigmoid", torch.nn.Softmax: "softmax",
+               torch.nn.LogSoftmax: "logsoftmax", torch.nn.Tanh: "tanh"}
+
+
+def save_state_dict(path, state_dict, metadata=None):
+    """
+    Write ``state_dict`` in the safetensors layout: an 8-byte little-endian
+    header length, a JSON header of dtype, shape and byte offsets per tensor,
+    and the raw tensor bytes. ``metadata`` values are stored JSON-encoded in
+    ``__metadata__``.
+    """
+    header, tensors, offset = {}, [], 0
+    for name, tensor in state_dict.items():
+        tensor = tensor.detach().cpu().contiguous()
+        nbytes = tensor.numel() * tensor.element_size()
+        header[name] = {"dtype": SAFETENSORS_DTYPES[tensor.dtype], "shape": list(tensor.shape),
+                        "data_offsets": [offset, offset + nbytes]}
+        tensors.append(tensor)
+        offset += nbytes
+
+    if metadata:
+        header["__metadata__"] = {k: json.dumps(v) for k, v in metadata.items()}
+
+    encoded = json.dumps(header, separators=(",", ":")).encode()
+    # Pad the header so the tensor data starts 8-byte aligned
+    encoded += b" " * (-len(encoded) % 8)
+
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(struct.pack("<Q", len(encoded)))
+        f.write(encoded)
+        for tensor in tensors:
+            f.write(tensor.reshape(-1).view(torch.uint8).numpy().tobytes())
+    os.replace(tmp, path)
+
+
+def read_header(path):
+    with open(path, "rb") as f:
+        length = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(length))
+    metadata = {k: json.loads(v) for k, v in header.pop("__metadata__", {}).items()}
+    return header, metadata, 8 + length
+
+
+def load_state_dict(path):
+    """
+    Map a file written by ``save_state_dict`` and return ``(state_dict, metadata)``.
+    Tensors are views of a copy-on-write memory map, so pages are only read
+    when a tensor is used and nothing is unpickled.
+    """
+    header, metadata, start = read_header(path)
+    if not header:
+        return {}, metadata
+
+    data = np.memmap(path, dtype=np.uint8, mode="c", offset=start)
+    state_dict = {}
+    for name, info in header.items():
+        begin, end = info["data_offsets"]
+        dtype = TORCH_DTYPES[info["dtype"]]
+        tensor = torch.frombuffer(data[begin:end], dtype=dtype) if end > begin else torch.empty(0, dtype=dtype)
+        state_dict[name] = tensor.reshape(info["shape"])
+    return state_dict, metadata
+
+
+def unet_metadata(model, image_size=None, config=None):
+    """Everything needed to rebuild ``model``, plus the plain values of its training config."""
+    conv, activation = model.segmentation_head[0], model.segmentation_head[2].activation
+    metadata = {
+        "architecture": "Unet",
+        "encoder": model.name[len("u-"):],
+        "classes": conv.out_channels,
+        "in_channels": model.encoder._in_channels,
+        "encoder_depth": model.encoder._depth,
+        "decoder_channels": [block.conv2[0].out_channels for block in model.decoder.blocks],
+        "activation": "softmax2d" if isinstance(activation, torch.nn.Softmax) and activation.dim == 1 else ACTIVATIONS.get(type(activation)),
+        "image_size": image_size
+    }
+    if config is not None:
+        metadata["config"] = {k: v for k, v in ((k, getattr(config, k)) for k in dir(config) if not k.startswith("_"))
+                              if v is None or isinstance(v, (str, int, float, bool))}
+    return metadata
+
+
+def save_unet(path, model, image_size=None, config=None):
+    save_state_dict(path, model.state_dict(), unet_metadata(model, image_size, config))
+
+
+def load_unet(path):
+    state_dict, metadata = load_state_dict(path)
+    model = smp.Unet(encoder_name=metadata["encoder"], encoder_weights=None, encoder_depth=metadata["encoder_depth"],
+                     decoder_channels=metadata["decoder_channels"], in_channels=metadata["in_channels"],
+                     classes=metadata["classes"], activation=metadata["activation"])
+    # assign keeps the memory-mapped tensors instead of copying them into freshly allocated weights
+    model.load_state_dict(state_dict, assign=True)
+    return model
+
+
+def resolve_checkpoint(path):
+    """The ``.safetensors`` sibling of a legacy ``unet_*.pt`` path when one exists, else the path itself."""
+    root, ext = os.path.splitext(path)
+    if ext == ".pt" and os.path.exists(f"{root}.safetensors"):
+        return f"{root}.safetensors"
+    return path
+
+
+def load_model(path):
+    path = resolve_checkpoint(path)
+    if path.endswith(".safetensors"):
+        return load_unet(path)
+    # Legacy pickled whole model
+    return torch.load(path, map_location="cpu", weights_only=False)
@@ -0,0 +1,116 @@
+import os
+import re
+import warnings
+from contextlib import contextmanager
+
+import torch
+
+COMPILE_MODES = (None, "eager", "compile", "script")
+
+
+def artifact_key(encoder, shape, precision="fp32"):
+    """Cache key of compiled artifacts: encoder, input shape without the batch, precision and torch version."""
+    key = f"{encoder}-{'x'.join(str(s) for s in shape)}-{precision}-torch{torch.__version__}"
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", key)
+
+
+@contextmanager
+def inductor_cache_dir(path):
+    """Point inductor at ``path`` inside the block and restore the previous setting after it."""
+    if path is None:
+        yield
+        return
+
+    previous = os.environ.get("TORCHINDUCTOR_CACHE_DIR")
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = path
+    try:
+        yield
+    finally:
+        if previous is None:
+            os.environ.pop("TORCHINDUCTOR_CACHE_DIR", None)
+        else:
+            os.environ["TORCHINDUCTOR_CACHE_DIR"] = previous
+
+
+class CompiledModule(torch.nn.Module):
+    """
+    Runs ``module`` through torch.compile (mode "compile") or a TorchScript
+    trace (mode "script"), built lazily from the first input. A model that
+    fails to compile falls back to tracing. Traces are taken separately for
+    train and eval mode and per input shape, because a trace records the
+    BatchNorm mode and the shapes it saw. Traced and compiled code share
+    parameters with ``module``, so optimizers and ``state_dict`` keep working on
+    the original model. With ``cache_dir``, inductor artifacts are kept in a
+    directory per ``key`` and reused by later runs with the same key.
+    """
+    def __init__(self, module, mode="compile", cache_dir=None, key=None, backend="inductor"):
+        super().__init__()
+        if mode not in COMPILE_MODES:
+            raise ValueError(f"Unknown compile mode {mode}, expected one of {COMPILE_MODES}")
+
+        self.module = module
+        self.mode = mode
+        self.cache_dir = cache_dir
+        self.key = key
+        self.backend = backend
+        self._compiled = {}
+        self.train(module.training)
+
+    def artifact_dir(self):
+        if self.cache_dir is None or self.key is None:
+            return None
+        return os.path.join(self.cache_dir, self.key)
+
+    def run_compiled(self, x):
+        # Inductor reads its cache location whenever it (re)compiles, e.g. for a new shape or after
+        # switching between train and eval, so every call sees this key's directory and only this module does
+        with inductor_cache_dir(self.artifact_dir()):
+            return self._compiled["compile"](x)
+
+    def compile(self, x):
+        self._compiled["compile"] = torch.compile(self.module, backend=self.backend)
+        return self.run_compiled(x)
+
+    def trace(self, x):
+        # Tracing runs a forward pass; keep it from updating BatchNorm statistics a second time
+        buffers = {name: buffer.clone() for name, buffer in self.module.named_buffers()}
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", torch.jit.TracerWarning)
+            traced = torch.jit.trace(self.module, x, check_trace=False)
+        with torch.no_grad():
+            for name, buffer in self.module.named_buffers():
+                buffer.copy_(buffers[name])
+        return traced, traced(x)
+
+    def forward(self, x):
+        if self.mode in (None, "eager"):
+            return self.module(x)
+
+        if self.mode == "compile":
+            if "compile" not in self._compiled:
+                try:
+                    return self.compile(x)
+                except Exception as e:
+                    print(f"torch.compile failed ({type(e).__name__}: {e}), falling back to TorchScript")
+                    self._compiled.pop("compile", None)
+                    self.mode = "script"
+            else:
+                return self.run_compiled(x)
+
+        key = (self.training, tuple(x.shape))
+        if key not in self._compiled:
+            self._compiled[key], out = self.trace(x)
+            return out
+        return self._compiled[key](x)
+
+    def __getstate__(self):
+        # Compiled code is rebuilt wherever the module is unpickled
+        state = self.__dict__.copy()
+        state["_compiled"] = {}
+        return state
+
+
+def compile_model(model, mode, cache_dir=None, key=None):
+    if mode in (None, "eager"):
+        return model
+    return CompiledModule(model, mode, cache_dir, key)
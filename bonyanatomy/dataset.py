@@ -1,61 +1,154 @@
-import cv2
+import gzip
 import pydicom
 import nibabel
 import numpy as np
 import os
 
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, default_collate
 from sklearn.model_selection import StratifiedKFold
 
+from bonyanatomy.cache import MemmapSampleCache, PyramidCache, shared_sample_cache
+from bonyanatomy.storage import get_storage
+
 
 class BonyAnatomyJointSegmentationDataset(Dataset):
-    def __init__(self, root_dir, ids, transforms=None):
+    def __init__(self, root_dir, ids, transforms=None, cache_dir=None, shared_cache=False, pyramid_dir=None, image_size=None):
         self.root_dir = root_dir
+        self.storage = get_storage(root_dir)
         self.pids = ids
         self.transforms = transforms
+        self.shared_cache = shared_cache
+        self.image_size = image_size
+
+        # Pre-resized levels from Code/build_pyramid.py; ids it lacks are decoded from the source
+        self.pyramid = None
+        if pyramid_dir is not None and image_size is not None:
+            self.pyramid = PyramidCache(pyramid_dir)
+
+        # Built by build_cache, or on first access, so splits that are never read are not decoded
+        self.cache_dir = cache_dir
+        self.cache = None
+
+    def build_cache(self):
+        if self.cache_dir is not None and self.cache is None:
+            self.cache = MemmapSampleCache.build(self.cache_dir, self)
+        return self.cache
+
+    def read_dicom(self, path):
+        return pydicom.dcmread(path).pixel_array
 
     def load_dicom(self, path):
-        dicom_img = pydicom.dcmread(path)
-        return dicom_img.pixel_array.astype(np.float32)
+        return self.read_dicom(path).astype(np.float32)
+
+    def read_nii(self, source):
+        if isinstance(source, str):
+            return nibabel.load(source)
+
+        # In-memory buffer from an archive or remote store, decompressed lazily up to the needed slice
+        if source.read(2) == b"\x1f\x8b":
+            source.seek(0)
+            source = gzip.GzipFile(fileobj=source)
+        source.seek(0)
+        return nibabel.Nifti1Image.from_stream(source)
 
     def load_nii(self, path):
-        nii_annot = nibabel.load(path)
-        nii_annot_data = nii_annot.get_fdata()
+        nii_annot = self.read_nii(path)
+        shape = nii_annot.shape
 
-        if len(nii_annot_data.shape) == 3 and nii_annot_data.shape[-1] > 1:
-            if nii_annot_data.shape[-1] == 2:
-                nii_annot_data = nii_annot_data[:, :, 1]
+        # Read only the annotated slice through the proxy, in its stored dtype
+        if len(shape) == 3 and shape[-1] > 1:
+            if shape[-1] == 2:
+                nii_annot_data = np.asanyarray(nii_annot.dataobj[:, :, 1])
             else:
-                nii_annot_data = nii_annot_data[:, :, nii_annot_data.shape[-1]//2]
+                nii_annot_data = np.asanyarray(nii_annot.dataobj[:, :, shape[-1]//2])
+        elif len(shape) == 3:
+            nii_annot_data = np.asanyarray(nii_annot.dataobj[:, :, 0])
+        else:
+            nii_annot_data = np.asanyarray(nii_annot.dataobj)
 
-            nii_annot_data = np.expand_dims(nii_annot_data, axis=-1)
+        # Rotating 90 degrees clockwise and then flipping horizontally is a transpose. Slices are
+        # stored column-major, so the transpose is often a view of nibabel's read-only buffer; copy it
+        return np.array(nii_annot_data.T, dtype=np.uint8, order="C")
 
+    def get_file_path(self, filename):
+        # A local path, or an in-memory buffer for archive and remote storage
+        return self.storage.source(filename)
 
-        nii_annot_data = cv2.rotate(nii_annot_data, cv2.ROTATE_90_CLOCKWISE)
-        nii_annot_data = cv2.flip(nii_annot_data, 1)
-        return nii_annot_data
+    def get_image_path(self, pid):
+        return os.path.join("Images/", str(pid) + ".dcm")
 
-    def get_file_path(self, filename):
-        return os.path.join(self.root_dir, filename)
+    def get_annotation_path(self, pid):
+        return os.path.join("Annotations", str(pid) + ".nii.gz")
+
+    def decode_sample(self, pid):
+        image = self.read_dicom(self.get_file_path(self.get_image_path(pid)))
+        mask = self.load_nii(self.get_file_path(self.get_annotation_path(pid)))
+        return image, mask
+
+    def load_sample(self, pid):
+        if self.pyramid is not None and pid in self.pyramid:
+            sample = self.pyramid.load(pid, self.image_size)
+            if sample is not None:
+                return sample[0].astype(np.float32), np.array(sample[1])
+
+        if self.shared_cache:
+            # Entries are shared by every dataset in the process, so callers get their own mask
+            image, mask = shared_sample_cache.load(self, pid)
+            return image.astype(np.float32), mask.copy()
+
+        image, mask = self.decode_sample(pid)
+        return image.astype(np.float32), mask
+
+    def transform(self, image, mask):
+        if self.transforms is not None:
+            transformed = self.transforms(image=image, mask=mask)
+            image = transformed["image"]
+            mask = transformed["mask"]
+        return image, mask
 
     def __len__(self):
         return len(self.pids)
 
     def __getitem__(self, idx):
+        if self.build_cache() is not None:
+            # Cached rows are already transformed; they are only copied when the stored dtype differs
+            image, mask = self.cache[self.pids[idx]]
+            return torch.from_numpy(image.astype(np.float32, copy=False)), torch.from_numpy(mask.astype(np.int64, copy=False))
 
-        image = self.load_dicom(self.get_file_path(os.path.join("Images/", str(self.pids[idx]) + ".dcm")))
-        mask = self.load_nii(self.get_file_path(os.path.join("Annotations", str(self.pids[idx]) + ".nii.gz")))
+        image, mask = self.transform(*self.load_sample(self.pids[idx]))
 
 #         if len(np.unique(mask)) != self.num_classes:
 #             print(self.pids[idx])
-        if self.transforms is not None:
-            transformed = self.transforms(image=image, mask=mask)
-            image = transformed["image"]
-            mask = transformed["mask"]
-    
+
+        if self.transforms is None:
+            # Raw samples of varying shape, resized per batch by BatchResize
+            return torch.from_numpy(image), torch.from_numpy(mask)
 
         return image.type(torch.FloatTensor), mask.long()
+
+
+class IndexedDataset(Dataset):
+    """Wraps a dataset so every sample also carries its index, used to look up split membership per batch."""
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        image, mask = self.dataset[idx]
+        return image, mask, idx
+
+
+class IndexedCollate:
+    """Applies ``collate_fn`` (default collation when None) to the samples and stacks their indices."""
+    def __init__(self, collate_fn=None):
+        self.collate_fn = collate_fn or default_collate
+
+    def __call__(self, batch):
+        images, masks = self.collate_fn([(image, mask) for image, mask, _ in batch])
+        return images, masks, torch.tensor([idx for _, _, idx in batch])
     
 class StratifiedSampler:
     """
@@ -79,4 +172,19 @@ class StratifiedSampler:
         return iter(self.gen_stratified_sample())
 
     def __len__(self):
-        return self.nsplits
\ No newline at end of file
+        return self.nsplits
+
+def stratified_subsample(records, columns, fraction, random_state=42):
+    """
+    Positions of a fixed subsample of ``records`` holding ``fraction`` of every
+    stratum formed by ``columns``, with at least one sample per stratum.
+    """
+    strata = records[columns].astype(str).agg("|".join, axis=1).reset_index(drop=True)
+    rng = np.random.default_rng(random_state)
+
+    positions = []
+    for _, group in strata.groupby(strata, sort=True):
+        n = max(1, int(round(len(group) * fraction)))
+        positions.extend(rng.choice(group.index.to_numpy(), size=n, replace=False))
+
+    return sorted(int(p) for p in positions)
@@ -0,0 +1,96 @@
+import os
+import contextlib
+
+import torch
+import torch.distributed as dist
+from torch.distributed.algorithms.join import Join
+
+
+def init_distributed(backend="gloo"):
+    """
+    Join the process group described by the torchrun environment variables and
+    return ``(rank, world_size)``. Without them this is a single process, (0, 1).
+    """
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size == 1:
+        return 0, 1
+
+    if not dist.is_initialized():
+        dist.init_process_group(backend)
+    return dist.get_rank(), dist.get_world_size()
+
+
+def local_device(device):
+    # One GPU per local rank when training on CUDA, the CPU is shared
+    if torch.device(device).type == "cuda" and dist.is_initialized():
+        return f"cuda:{int(os.environ.get('LOCAL_RANK', 0))}"
+    return device
+
+
+@contextlib.contextmanager
+def main_process_first(rank, world_size):
+    """Let rank 0 run the block before the others, e.g. to build a cache the other ranks then reuse."""
+    if world_size > 1 and rank != 0:
+        dist.barrier()
+    yield
+    if world_size > 1 and rank == 0:
+        dist.barrier()
+
+
+def reduce_logs(logs, world_size):
+    """
+    Average the per-rank epoch logs (loss and metric means) across ranks. A rank
+    that got no batches, e.g. with fewer shards than ranks, has no logs and is
+    left out of the average.
+    """
+    if world_size == 1:
+        return logs
+
+    keys = [None] * world_size
+    dist.all_gather_object(keys, list(logs))
+    keys = next((k for k in keys if k), [])
+
+    values = torch.tensor([float(logs[k]) if logs else 0.0 for k in keys] + [1.0 if logs else 0.0], dtype=torch.float64)
+    dist.all_reduce(values)
+    return {k: v / values[-1].item() for k, v in zip(keys, values[:-1].tolist())}
+
+
+class DistributedBatchSampler:
+    """
+    Splits every batch of ``batch_sampler`` across ranks, so the global batch
+    keeps the composition chosen by e.g. the stratified sampler. Batches that do
+    not divide evenly are padded with their own first indices, so every rank
+    takes the same number of steps.
+    """
+    def __init__(self, batch_sampler, rank, world_size):
+        self.batch_sampler = batch_sampler
+        self.rank = rank
+        self.world_size = world_size
+
+    def __iter__(self):
+        for batch in self.batch_sampler:
+            batch = list(batch)
+            padding = -len(batch) % self.world_size
+            batch = batch + (batch * self.world_size)[:padding]
+            yield batch[self.rank::self.world_size]
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def set_epoch(self, epoch):
+        if hasattr(self.batch_sampler, "set_epoch"):
+            self.batch_sampler.set_epoch(epoch)
+
+
+def set_loader_epoch(loader, epoch):
+    # Reshuffles DistributedSampler splits each epoch, like DataLoader(shuffle=True) does
+    for sampler in (loader.sampler, loader.batch_sampler):
+        if hasattr(sampler, "set_epoch"):
+            sampler.set_epoch(epoch)
+
+
+def join_uneven(model, world_size):
+    """Keep ranks that run out of batches early in step with the others, e.g. for shards of unequal size."""
+    if world_size == 1:
+        return contextlib.nullcontext()
+    return Join([model])
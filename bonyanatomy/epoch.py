@@ -0,0 +1,208 @@
+import sys
+import contextlib
+
+import torch
+from tqdm import tqdm
+from segmentation_models_pytorch import utils as smp_utils
+from segmentation_models_pytorch.utils.meter import AverageValueMeter
+
+
+PRECISIONS = {
+    "fp32": None,
+    "bf16": torch.bfloat16,
+    "fp16": torch.float16
+}
+
+
+def autocast(precision, device):
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision}, expected one of {list(PRECISIONS)}")
+
+    if PRECISIONS[precision] is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=torch.device(device).type, dtype=PRECISIONS[precision])
+
+
+def grad_scaler(precision, device):
+    # Loss scaling is only needed for fp16, bf16 has the exponent range of fp32
+    if precision != "fp16":
+        return None
+
+    try:
+        return torch.amp.GradScaler(torch.device(device).type)
+    except (AttributeError, RuntimeError):
+        print(f"Gradient scaling is not supported on {device}, training fp16 without it")
+        return None
+
+
+def tensor_bytes(tensors):
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+class TrainEpoch(smp_utils.train.TrainEpoch):
+    """
+    smp's TrainEpoch with autocast and gradient accumulation. Each loader batch
+    is one optimizer step; it is split into micro-batches of ``micro_batch_size``
+    whose losses are weighted by their share of the batch, so the step matches
+    the full-batch one. With a ``memory_budget`` in bytes and no fixed micro-batch
+    size, the size is picked by probing the first batch.
+    """
+    def __init__(self, model, loss, metrics, optimizer, device="cpu", verbose=True, precision="fp32",
+                 micro_batch_size=None, memory_budget=None):
+        super().__init__(model, loss=loss, metrics=metrics, optimizer=optimizer, device=device, verbose=verbose)
+        self.precision = precision
+        self.scaler = grad_scaler(precision, device)
+        self.micro_batch_size = micro_batch_size
+        self.memory_budget = memory_budget
+
+    def on_epoch_start(self):
+        self.model.train()
+        # A frozen encoder stays in eval mode so its BatchNorm statistics are not updated either
+        encoder = getattr(getattr(self.model, "module", self.model), "encoder", None)
+        if encoder is not None and not any(p.requires_grad for p in encoder.parameters()):
+            encoder.eval()
+
+    def probe_memory(self, x, y):
+        """Peak training memory of one forward and backward pass over ``x``, in bytes."""
+        if torch.device(self.device).type == "cuda":
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+            with autocast(self.precision, self.device):
+                loss = self.loss(self.model.forward(x), y)
+            loss.backward()
+            return torch.cuda.max_memory_allocated(self.device)
+
+        # On the CPU, count the activations autograd keeps for the backward pass.
+        # Their gradients take about as much again while it runs.
+        saved = []
+        with torch.autograd.graph.saved_tensors_hooks(lambda t: saved.append(t) or t, lambda t: t):
+            with autocast(self.precision, self.device):
+                loss = self.loss(self.model.forward(x), y)
+        loss.backward()
+
+        parameters = [p for p in self.model.parameters() if p.requires_grad]
+        # Weights, their gradients and two Adam moments
+        return 2 * tensor_bytes(saved) + 4 * tensor_bytes(parameters)
+
+    def choose_micro_batch_size(self, x, y):
+        # Probing runs real forward passes; restore BatchNorm statistics and drop the gradients afterwards
+        buffers = {k: v.clone() for k, v in self.model.state_dict().items()}
+        one = self.probe_memory(x[:1], y[:1])
+        self.optimizer.zero_grad()
+        two = self.probe_memory(x[:2], y[:2]) if len(x) > 1 else None
+        self.model.load_state_dict(buffers)
+        self.optimizer.zero_grad()
+
+        # Fit fixed + per_sample * n through the one- and two-sample probes
+        per_sample = two - one if two is not None and two > one else one
+        fixed = one - per_sample
+        size = int(max(1, min(len(x), (self.memory_budget - fixed) // max(per_sample, 1))))
+        print(f"Micro-batch size {size} of {len(x)}: about {per_sample / 2**20:.1f} MiB per sample, "
+              f"{fixed / 2**20:.1f} MiB fixed, {self.memory_budget / 2**20:.1f} MiB budget")
+        return size
+
+    def batch_update(self, x, y):
+        if self.micro_batch_size is None and self.memory_budget is not None:
+            self.micro_batch_size = self.choose_micro_batch_size(x, y)
+
+        size = self.micro_batch_size or len(x)
+        starts = range(0, len(x), size)
+        self.optimizer.zero_grad()
+
+        total_loss, predictions = 0.0, []
+        for n, start in enumerate(starts):
+            micro_x, micro_y = x[start:start + size], y[start:start + size]
+            # DDP only needs to all-reduce the accumulated gradients once, on the last micro-batch
+            sync = n == len(starts) - 1 or not hasattr(self.model, "no_sync")
+            with (contextlib.nullcontext() if sync else self.model.no_sync()):
+                with autocast(self.precision, self.device):
+                    prediction = self.model.forward(micro_x)
+                    loss = self.loss(prediction, micro_y) * (len(micro_x) / len(x))
+
+                if self.scaler is not None:
+                    self.scaler.scale(loss).backward()
+                else:
+                    loss.backward()
+
+            total_loss = total_loss + loss.detach().float()
+            predictions.append(prediction.detach().float())
+
+        if self.scaler is not None:
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+        else:
+            self.optimizer.step()
+
+        return total_loss, torch.cat(predictions)
+
+
+class ValidEpoch(smp_utils.train.ValidEpoch):
+    def __init__(self, model, loss, metrics, device="cpu", verbose=True, precision="fp32"):
+        super().__init__(model, loss=loss, metrics=metrics, device=device, verbose=verbose)
+        self.precision = precision
+
+    def batch_update(self, x, y):
+        with torch.no_grad(), autocast(self.precision, self.device):
+            prediction = self.model.forward(x)
+            loss = self.loss(prediction, y)
+        return loss.float(), prediction.float()
+
+
+def run_shared_epoch(runners, dataloader, membership, batch_sizes, stage_name="train", verbose=True):
+    """
+    One epoch of every runner from a single pass over ``dataloader``, which yields
+    ``(x, y, index)``. ``membership[m, index]`` marks the samples that belong to
+    runner ``m``. They are buffered until ``batch_sizes[m]`` samples are ready,
+    so each model trains on full batches as it would on its own loader. Returns
+    the logs of each runner, in the format of ``Epoch.run``.
+    """
+    for runner in runners:
+        runner.on_epoch_start()
+
+    loss_meters = [AverageValueMeter() for _ in runners]
+    metric_meters = [{metric.__name__: AverageValueMeter() for metric in runner.metrics} for runner in runners]
+    buffers = [[] for _ in runners]
+
+    def step(m, x, y):
+        runner = runners[m]
+        x, y = x.to(runner.device), y.to(runner.device)
+        loss, y_pred = runner.batch_update(x, y)
+
+        loss_meters[m].add(loss.cpu().detach().numpy())
+        for metric_fn in runner.metrics:
+            metric_meters[m][metric_fn.__name__].add(metric_fn(y_pred, y).cpu().detach().numpy())
+
+    def drain(m, final=False):
+        buffered = sum(len(x) for x, _ in buffers[m])
+        if buffered == 0 or (buffered < batch_sizes[m] and not final):
+            return
+
+        x = torch.cat([x for x, _ in buffers[m]])
+        y = torch.cat([y for _, y in buffers[m]])
+        full = len(x) - len(x) % batch_sizes[m]
+        for start in range(0, full, batch_sizes[m]):
+            step(m, x[start:start + batch_sizes[m]], y[start:start + batch_sizes[m]])
+
+        # Keep the remainder for the next pass, or run it as the last partial batch like a DataLoader does
+        buffers[m] = [(x[full:], y[full:])] if full < len(x) else []
+        if final and buffers[m]:
+            step(m, *buffers[m].pop())
+
+    with tqdm(dataloader, desc=stage_name, file=sys.stdout, disable=not verbose) as iterator:
+        for x, y, index in iterator:
+            selected = membership[:, index]
+            for m in range(len(runners)):
+                if selected[m].any():
+                    buffers[m].append((x[selected[m]], y[selected[m]]))
+                    drain(m)
+
+    for m in range(len(runners)):
+        drain(m, final=True)
+
+    logs = []
+    for runner, loss_meter, meters in zip(runners, loss_meters, metric_meters):
+        runner_logs = {runner.loss.__name__: loss_meter.mean}
+        runner_logs.update({name: meter.mean for name, meter in meters.items()})
+        logs.append(runner_logs)
+
+    return logs
@@ -0,0 +1,142 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+from bonyanatomy.cache import cache_key
+
+# Storage dtype per feature precision; bf16 has no numpy dtype and is kept as its int16 bit pattern
+FEATURE_DTYPES = {
+    "fp16": (torch.float16, np.float16),
+    "bf16": (torch.bfloat16, np.int16)
+}
+
+
+def module_digest(module):
+    h = hashlib.sha1()
+    for name, tensor in module.state_dict().items():
+        h.update(name.encode())
+        h.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()
+
+
+class EncoderFeatureCache(Dataset):
+    """
+    Memory-mapped multi-scale encoder features of every sample in a dataset,
+    for training the decoder of a U-Net whose encoder is frozen. Each row holds
+    the flattened encoder outputs the decoder uses, in fp16 or bf16, and
+    ``masks.npy`` the matching masks. Rows follow the dataset order, so
+    indices from the dataset's samplers address the same samples. The
+    directory name hashes the dataset's cache key, the id order, the encoder
+    weights and the dtype.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "index.json")) as f:
+            index = json.load(f)
+        self.shapes = [tuple(shape) for shape in index["shapes"]]
+        self.dtype = index["dtype"]
+        self.size = index["size"]
+        self._features = None
+        self._masks = None
+
+    @classmethod
+    def build(cls, cache_dir, dataset, encoder, dtype="fp16", batch_size=16, collate_fn=None, device="cpu"):
+        if dtype not in FEATURE_DTYPES:
+            raise ValueError(f"Unknown feature dtype {dtype}, expected one of {list(FEATURE_DTYPES)}")
+        torch_dtype, numpy_dtype = FEATURE_DTYPES[dtype]
+
+        h = hashlib.sha1()
+        h.update(cache_key(dataset).encode())
+        h.update(",".join(str(pid) for pid in dataset.pids).encode())
+        h.update(f"{module_digest(encoder)}:{dtype}:{getattr(collate_fn, 'image_size', None)}".encode())
+        path = os.path.join(cache_dir, h.hexdigest())
+        if os.path.exists(os.path.join(path, "index.json")):
+            return cls(path)
+
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix=".building-", dir=cache_dir)
+        print(f"Building encoder feature cache for {len(dataset)} samples in {path}")
+
+        encoder.eval()
+        loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, collate_fn=collate_fn)
+        features, masks, shapes, offset = None, None, None, 0
+        with torch.inference_mode():
+            for x, y in loader:
+                # The decoder drops the first output, the input itself, so it is not stored
+                outputs = encoder(x.to(device))[1:]
+                if features is None:
+                    shapes = [tuple(output.shape[1:]) for output in outputs]
+                    width = sum(int(np.prod(shape)) for shape in shapes)
+                    features = np.lib.format.open_memmap(os.path.join(tmp, "features.npy"), mode="w+",
+                                                         dtype=numpy_dtype, shape=(len(dataset), width))
+                    masks = np.lib.format.open_memmap(os.path.join(tmp, "masks.npy"), mode="w+",
+                                                      dtype=np.uint8, shape=(len(dataset),) + tuple(y.shape[1:]))
+
+                flat = torch.cat([output.flatten(1) for output in outputs], dim=1).to(torch_dtype).cpu()
+                if dtype == "bf16":
+                    flat = flat.view(torch.int16)
+                features[offset:offset + len(flat)] = flat.numpy()
+                masks[offset:offset + len(flat)] = y.numpy()
+                offset += len(flat)
+
+        if features is not None:
+            features.flush()
+            masks.flush()
+        del features, masks
+
+        with open(os.path.join(tmp, "index.json"), "w") as f:
+            json.dump({"shapes": shapes, "dtype": dtype, "size": len(dataset)}, f)
+
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # Another process finished building the same cache first
+            shutil.rmtree(tmp, ignore_errors=True)
+
+        return cls(path)
+
+    def open(self):
+        if self._features is None:
+            self._features = np.load(os.path.join(self.path, "features.npy"), mmap_mode="r")
+            self._masks = np.load(os.path.join(self.path, "masks.npy"), mmap_mode="r")
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_features"] = None
+        state["_masks"] = None
+        return state
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, idx):
+        self.open()
+        return torch.from_numpy(np.array(self._features[idx])), torch.from_numpy(self._masks[idx].astype(np.int64))
+
+
+class DecoderHead(torch.nn.Module):
+    """
+    The decoder and segmentation head of ``model``, taking the flattened feature
+    rows of an ``EncoderFeatureCache`` as input. The modules are shared with
+    ``model``, so training this trains the U-Net's decoder in place.
+    """
+    def __init__(self, model, shapes, dtype="fp16"):
+        super().__init__()
+        self.decoder = model.decoder
+        self.segmentation_head = model.segmentation_head
+        self.shapes = shapes
+        self.dtype = dtype
+
+    def forward(self, x):
+        if self.dtype == "bf16":
+            x = x.view(torch.bfloat16)
+
+        sizes = [int(np.prod(shape)) for shape in self.shapes]
+        features = [part.reshape((-1,) + shape).float() for part, shape in zip(x.split(sizes, dim=1), self.shapes)]
+        return self.segmentation_head(self.decoder(None, *features))
@@ -0,0 +1,111 @@
+import os
+import time
+from dataclasses import dataclass, asdict
+
+import torch
+from torch.utils.data import DataLoader
+
+
+@dataclass
+class LoaderProfile:
+    num_workers: int = 0
+    pin_memory: bool = False
+    persistent_workers: bool = False
+    prefetch_factor: int = None
+
+    def loader_kwargs(self):
+        kwargs = {
+            "num_workers": self.num_workers,
+            "pin_memory": self.pin_memory and torch.cuda.is_available()
+        }
+
+        # DataLoader rejects these options when loading in the main process
+        if self.num_workers > 0:
+            kwargs["persistent_workers"] = self.persistent_workers
+            if self.prefetch_factor is not None:
+                kwargs["prefetch_factor"] = self.prefetch_factor
+
+        return kwargs
+
+    def to_dict(self):
+        return asdict(self)
+
+
+def measure_throughput(dataset, profile, num_batches=10, **loader_kwargs):
+    loader = DataLoader(dataset, **loader_kwargs, **profile.loader_kwargs())
+
+    samples = 0
+    start = None
+    for i, (image, _) in enumerate(loader):
+        # Worker start-up is paid once per run with persistent workers, so time from the first batch
+        if start is None:
+            start = time.perf_counter()
+            continue
+
+        samples += len(image)
+        if i >= num_batches:
+            break
+
+    if start is None or samples == 0:
+        return 0.0
+
+    return samples / (time.perf_counter() - start)
+
+
+def autotune_loader(dataset, worker_grid=None, prefetch_grid=(2, 4), num_batches=10, **loader_kwargs):
+    """
+    Benchmark samples/sec for each worker and prefetch setting on the given dataset
+    and return the fastest profile together with every measurement.
+    """
+    if worker_grid is None:
+        cpus = os.cpu_count() or 1
+        worker_grid = sorted({0} | {w for w in (2, 4, 8, 16) if w <= cpus})
+
+    candidates = []
+    for num_workers in worker_grid:
+        if num_workers == 0:
+            candidates.append(LoaderProfile())
+            continue
+        for prefetch_factor in prefetch_grid:
+            candidates.append(LoaderProfile(num_workers=num_workers, pin_memory=True,
+                                            persistent_workers=True, prefetch_factor=prefetch_factor))
+
+    results = []
+    for profile in candidates:
+        throughput = measure_throughput(dataset, profile, num_batches, **loader_kwargs)
+        print(f"Loader profile {profile}: {throughput:.1f} samples/sec")
+        results.append({"profile": profile.to_dict(), "samples_per_sec": throughput})
+
+    best = max(range(len(candidates)), key=lambda i: results[i]["samples_per_sec"])
+    return candidates[best], results
+
+
+def prefetch_to_device(loader, device):
+    """
+    Yield the batches of ``loader`` moved to ``device``. On CUDA the next batch
+    is copied on a side stream while the current one is being processed, which
+    needs a loader with pinned memory to actually overlap.
+    """
+    if torch.device(device).type != "cuda":
+        yield from loader
+        return
+
+    stream = torch.cuda.Stream(device)
+
+    def load(batch):
+        with torch.cuda.stream(stream):
+            return [t.to(device, non_blocking=True) for t in batch]
+
+    batches = iter(loader)
+    batch = next(batches, None)
+    upcoming = load(batch) if batch is not None else None
+    while upcoming is not None:
+        current = torch.cuda.current_stream(device)
+        current.wait_stream(stream)
+        for t in upcoming:
+            # The copies were allocated on the side stream but are used on the current one
+            t.record_stream(current)
+        batch = upcoming
+        following = next(batches, None)
+        upcoming = load(following) if following is not None else None
+        yield batch
@@ -0,0 +1,132 @@
+import glob
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import nibabel
+import pandas as pd
+import pydicom
+
+
+MANIFEST_NAME = "manifest.csv"
+# Studies excluded by hand before manifests existed, still excluded when no manifest is available
+FALLBACK_EXCLUSIONS = ["9025994"]
+INTEGER_COLUMNS = ["image_rows", "image_cols", "bits_stored", "image_bytes", "mask_rows", "mask_cols", "mask_slices", "mask_bytes"]
+
+
+def file_digest(path, chunk_size=1 << 20):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def read_dicom_header(path):
+    header = pydicom.dcmread(path, stop_before_pixels=True)
+    signed = getattr(header, "PixelRepresentation", 0) == 1
+    bits_allocated = int(header.BitsAllocated)
+    return {
+        "image_rows": int(header.Rows),
+        "image_cols": int(header.Columns),
+        "image_dtype": f"{'int' if signed else 'uint'}{bits_allocated}",
+        "bits_stored": int(getattr(header, "BitsStored", bits_allocated))
+    }
+
+
+def read_nifti_header(path):
+    header = nibabel.load(path).header
+    shape = header.get_data_shape()
+    return {
+        # Annotations are stored transposed relative to the radiograph
+        "mask_rows": int(shape[1]) if len(shape) > 1 else 0,
+        "mask_cols": int(shape[0]),
+        "mask_slices": int(shape[2]) if len(shape) > 2 else 1,
+        "mask_dtype": str(header.get_data_dtype())
+    }
+
+
+def scan_id(imaging_root, pid, hash_contents=True):
+    image_path = os.path.join(imaging_root, "Images", f"{pid}.dcm")
+    mask_path = os.path.join(imaging_root, "Annotations", f"{pid}.nii.gz")
+
+    record = {"id": pid, "valid": False, "error": ""}
+    try:
+        for path, prefix, read_header in ((image_path, "image", read_dicom_header), (mask_path, "mask", read_nifti_header)):
+            record.update(read_header(path))
+            record[f"{prefix}_bytes"] = os.path.getsize(path)
+            if hash_contents:
+                record[f"{prefix}_hash"] = file_digest(path)
+    except Exception as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+        return record
+
+    if (record["image_rows"], record["image_cols"]) != (record["mask_rows"], record["mask_cols"]):
+        record["error"] = "image and annotation shapes differ"
+        return record
+
+    record["valid"] = True
+    return record
+
+
+def list_ids(imaging_root):
+    images = glob.glob(os.path.join(imaging_root, "Images", "*.dcm"))
+    masks = glob.glob(os.path.join(imaging_root, "Annotations", "*.nii.gz"))
+    ids = {os.path.basename(p)[:-len(".dcm")] for p in images} | {os.path.basename(p)[:-len(".nii.gz")] for p in masks}
+    return sorted(ids)
+
+
+def build_manifest(imaging_root, ids=None, workers=32, hash_contents=True):
+    """
+    Scan the DICOM and NIfTI headers of every id under ``imaging_root`` in parallel,
+    without decoding pixel data, and return one row per id. Rows whose files are
+    missing, unreadable or disagree in shape are kept with ``valid`` set to False.
+    """
+    ids = list_ids(imaging_root) if ids is None else [str(pid) for pid in ids]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        records = list(pool.map(lambda pid: scan_id(imaging_root, pid, hash_contents), ids))
+
+    manifest = pd.DataFrame.from_records(records)
+    for c in INTEGER_COLUMNS:
+        if c in manifest.columns:
+            manifest[c] = manifest[c].astype("Int64")
+    return manifest
+
+
+def manifest_path(imaging_root):
+    return os.path.join(imaging_root, MANIFEST_NAME)
+
+
+def load_manifest(path):
+    manifest = pd.read_csv(path, dtype={"id": str}, keep_default_na=False)
+    manifest["valid"] = manifest["valid"].astype(str) == "True"
+    return manifest
+
+
+def valid_ids(manifest):
+    return set(manifest.id[manifest.valid])
+
+
+def filter_valid(records, manifest):
+    return records[records.id.astype(str).isin(valid_ids(manifest))].reset_index(drop=True)
+
+
+def exclude_invalid(records, manifest_file=None, fallback_ids=FALLBACK_EXCLUSIONS):
+    """
+    Keep the records whose ids ``manifest_file`` marks valid. Without a manifest
+    only ``fallback_ids`` are dropped, which reproduces the splits made before
+    manifests existed but cannot catch any other unreadable study.
+    """
+    if manifest_file is not None:
+        return filter_valid(records, load_manifest(manifest_file))
+
+    print(f"No manifest given, excluding only the known invalid ids {', '.join(fallback_ids)}")
+    return records[~records.id.astype(str).isin(fallback_ids)].reset_index(drop=True)
+
+
+def check_ids(manifest, ids, name="ids"):
+    invalid = sorted(set(str(pid) for pid in ids) - valid_ids(manifest))
+    if invalid:
+        errors = manifest.set_index("id").error.to_dict()
+        details = ", ".join(f"{pid} ({errors.get(pid) or 'not in manifest'})" for pid in invalid[:10])
+        raise ValueError(f"{len(invalid)} of the {name} are missing or invalid in the manifest: {details}")
@@ -0,0 +1,145 @@
+import abc
+
+import torch
+import torchmetrics
+
+AVERAGES = ("macro", "micro", "none")
+
+
+def confusion_matrices(preds, target, num_classes):
+    """
+    Per-image confusion matrices of label maps ``preds`` and ``target`` of shape
+    (N, H, W), counted with a single bincount. Returns (N, C, C) counts with
+    the target class on the rows and the predicted class on the columns.
+    """
+    n = len(preds)
+    offsets = torch.arange(n, device=preds.device).view(n, *([1] * (preds.ndim - 1))) * num_classes ** 2
+    index = offsets + target.long() * num_classes + preds.long()
+    return torch.bincount(index.reshape(-1), minlength=n * num_classes ** 2).view(n, num_classes, num_classes)
+
+
+def class_counts(confusion):
+    tp = torch.diagonal(confusion, dim1=-2, dim2=-1).float()
+    fp = confusion.sum(-2).float() - tp
+    fn = confusion.sum(-1).float() - tp
+    return tp, fp, fn
+
+
+def safe_divide(num, denom):
+    return torch.where(denom != 0, num / torch.where(denom != 0, denom, torch.ones_like(denom)), torch.zeros_like(num))
+
+
+def weighted_mean(scores, present):
+    # Classes absent from both prediction and target get no weight, as in torchmetrics
+    return ((present * scores) / present.sum(-1, keepdim=True)).sum(-1)
+
+
+def sum_present(values, present):
+    # torchmetrics drops absent classes before summing; summing the same number of
+    # terms keeps the float32 rounding identical, so rows are summed per class count
+    order = torch.sort((~present).int(), dim=-1, stable=True).indices
+    compact = values.gather(-1, order)
+    counts = present.sum(-1)
+    total = torch.zeros(values.shape[:-1], dtype=values.dtype, device=values.device)
+    for count in counts.unique().tolist():
+        rows = counts == count
+        total[rows] = compact[rows, :count].sum(-1)
+    return total
+
+
+class ConfusionMetric(torch.nn.Module, metaclass=abc.ABCMeta):
+    """
+    Segmentation metric computed from confusion matrices. ``from_confusion``
+    maps (..., C, C) counts to one score per matrix, so a batch of per-image
+    matrices from ``confusion_matrices`` gives every per-image score in one
+    go. Called on a batch of predictions (logits, probabilities or labels) and
+    targets, the metric returns the score of the whole batch and adds its counts
+    to the state read by ``compute``, like the torchmetrics classes it replaces.
+    """
+    def __init__(self, num_classes, average="macro"):
+        super().__init__()
+        if average not in AVERAGES:
+            raise ValueError(f"Unknown average {average}, expected one of {AVERAGES}")
+        self.num_classes = num_classes
+        self.average = average
+        self.register_buffer("confusion", torch.zeros(num_classes, num_classes, dtype=torch.long))
+
+    def batch_confusion(self, preds, target):
+        if preds.ndim == target.ndim + 1:
+            preds = preds.argmax(dim=1)
+        index = target.long().reshape(-1) * self.num_classes + preds.long().reshape(-1)
+        return torch.bincount(index, minlength=self.num_classes ** 2).view(self.num_classes, self.num_classes)
+
+    def update(self, preds, target):
+        self.confusion += self.batch_confusion(preds, target)
+
+    def forward(self, preds, target):
+        confusion = self.batch_confusion(preds, target)
+        self.confusion += confusion
+        return self.from_confusion(confusion)
+
+    def compute(self):
+        return self.from_confusion(self.confusion)
+
+    def reset(self):
+        self.confusion.zero_()
+
+    def from_confusion(self, confusion):
+        tp, fp, fn = class_counts(confusion)
+        num, denom = self.ratio(tp, fp, fn)
+        if self.average == "micro":
+            return safe_divide(num.sum(-1), denom.sum(-1))
+
+        scores = safe_divide(num, denom)
+        if self.average == "none":
+            return scores
+        return weighted_mean(scores, (tp + fp + fn != 0).float())
+
+    @abc.abstractmethod
+    def ratio(self, tp, fp, fn):
+        """Numerator and denominator of the per-class score."""
+
+
+class MulticlassJaccardIndex(ConfusionMetric):
+    def ratio(self, tp, fp, fn):
+        return tp, tp + fp + fn
+
+
+class Dice(ConfusionMetric):
+    def ratio(self, tp, fp, fn):
+        return 2 * tp, 2 * tp + fp + fn
+
+    def from_confusion(self, confusion):
+        if self.average != "macro":
+            return super().from_confusion(confusion)
+
+        tp, fp, fn = class_counts(confusion)
+        num, denom = self.ratio(tp, fp, fn)
+        present = denom != 0
+        return sum_present((present.float() / present.sum(-1, keepdim=True)) * safe_divide(num, denom), present)
+
+
+class Precision(ConfusionMetric):
+    def ratio(self, tp, fp, fn):
+        return tp, tp + fp
+
+
+class Recall(ConfusionMetric):
+    def ratio(self, tp, fp, fn):
+        return tp, tp + fn
+
+
+# torchmetrics classes with an equivalent here; evaluation computes them from confusion matrices
+EQUIVALENTS = {
+    torchmetrics.classification.MulticlassJaccardIndex: MulticlassJaccardIndex,
+    torchmetrics.classification.Dice: Dice,
+    torchmetrics.classification.MulticlassPrecision: Precision,
+    torchmetrics.classification.MulticlassRecall: Recall
+}
+
+
+def confusion_metric(metric):
+    """The ConfusionMetric class for ``metric``, itself one or a torchmetrics class listed in EQUIVALENTS, else None."""
+    if isinstance(metric, type) and issubclass(metric, ConfusionMetric):
+        return metric
+    return EQUIVALENTS.get(metric)
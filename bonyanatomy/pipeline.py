@@ -1,15 +1,139 @@
 import os
 import pandas as pd
 import numpy as np
-import copy
 import json
+import time
 
 import torch
-from torch.utils.data import DataLoader
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, DistributedSampler, IterableDataset, Subset
 import segmentation_models_pytorch as smp
 
 from segmentation_models_pytorch import utils as smp_utils
 
+from bonyanatomy.bias_metrics import bias_uncertainty
+from bonyanatomy.cache import shared_sample_cache, source_fingerprint
+from bonyanatomy.checkpoint import (StateSnapshot, capture_rng_state, restore_rng_state, save_training_checkpoint, load_training_checkpoint,
+                                     save_unet, load_model, resolve_checkpoint)
+from bonyanatomy.compile import artifact_key, compile_model
+from bonyanatomy.dataset import IndexedDataset, IndexedCollate, stratified_subsample
+from bonyanatomy.distributed import (DistributedBatchSampler, init_distributed, join_uneven, local_device, main_process_first,
+                                     reduce_logs, set_loader_epoch)
+from bonyanatomy.epoch import TrainEpoch, ValidEpoch, autocast, run_shared_epoch
+from bonyanatomy.features import EncoderFeatureCache, DecoderHead
+from bonyanatomy.loader import autotune_loader, prefetch_to_device
+from bonyanatomy.manifest import load_manifest, check_ids
+from bonyanatomy.metrics import ConfusionMetric, confusion_matrices, confusion_metric
+from bonyanatomy.predictions import PredictionStore
+from bonyanatomy.shards import ShardedJointSegmentationDataset
+from bonyanatomy.transforms import select_transforms
+
+def build_unet(config, device):
+    model = smp.Unet(encoder_name=config.encoder_backbone, encoder_weights=config.encoder_weights, in_channels=config.in_channels,
+                     classes=config.labels.get_num_classes(), activation=config.activation).to(device)
+    if config.freeze_encoder:
+        model.encoder.requires_grad_(False)
+    return model
+
+
+def micro_batch_size(config):
+    # Without an effective batch size, train_batch_size is the batch and needs no splitting
+    if config.effective_batch_size is None:
+        return None
+    if config.micro_batch_size is not None:
+        return config.micro_batch_size
+    return None if config.memory_budget is not None else config.train_batch_size
+
+
+def save_model(model, save_dir, config):
+    # Compiled models are saved as the module they wrap
+    model = getattr(model, "module", model)
+    if config.checkpoint_format == "pt":
+        torch.save(model, f"{save_dir}/unet_{config.encoder_backbone}.pt")
+    else:
+        save_unet(f"{save_dir}/unet_{config.encoder_backbone}.safetensors", model, config.image_size, config)
+
+
+def remove_checkpoint(save_dir):
+    # The full training state is only needed until the trained model is saved
+    path = f"{save_dir}/checkpoint.pt"
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def new_progress():
+    return {"epoch": 0, "max_score": 0, "last_improvement": 0, "stale_validations": 0, "stopped": False}
+
+
+def record_validation(progress, epoch, score, config, best_state, model):
+    """
+    Update ``progress`` with the validation score of ``epoch`` and return True
+    when it is the best so far, in which case ``best_state`` captured ``model``.
+    """
+    # Patience only resets on improvements larger than min_delta and is counted in validations
+    if score > progress["max_score"] + config.early_stopping_min_delta:
+        progress["last_improvement"] = epoch
+        progress["stale_validations"] = 0
+    else:
+        progress["stale_validations"] += 1
+
+    improved = progress["max_score"] < score
+    if improved:
+        progress["max_score"] = score
+        best_state.capture(model)
+
+    patience = config.early_stopping_patience
+    if patience is not None and progress["stale_validations"] >= patience:
+        progress["stopped"] = True
+    return improved
+
+
+def save_checkpoint(path, progress, model, optimizer, scaler, best_state):
+    save_training_checkpoint(path, {
+        **progress,
+        "model": model.state_dict(),
+        "optimizer": optimizer.state_dict(),
+        "scaler": scaler.state_dict() if scaler is not None else None,
+        "best_state": best_state.get(),
+        "rng": capture_rng_state()
+    })
+
+
+def restore_checkpoint(checkpoint, model, optimizer, scaler, best_state):
+    """Load a checkpoint read by ``load_training_checkpoint`` into the run's state and return its progress."""
+    model.load_state_dict(checkpoint["model"])
+    optimizer.load_state_dict(checkpoint["optimizer"])
+    if scaler is not None and checkpoint["scaler"] is not None:
+        scaler.load_state_dict(checkpoint["scaler"])
+    if checkpoint["best_state"] is not None:
+        best_state.load(checkpoint["best_state"])
+    restore_rng_state(checkpoint["rng"])
+    return {key: checkpoint.get(key, default) for key, default in
+            (("epoch", 0), ("max_score", 0), ("last_improvement", checkpoint["epoch"]), ("stale_validations", 0),
+             ("stopped", False))}
+
+
+def trainable_parameters(model):
+    return [p for p in model.parameters() if p.requires_grad]
+
+
+def build_loss_and_metrics(config, device):
+    num_classes = config.labels.get_num_classes()
+    loss = config.loss_function()
+    loss.__name__=" loss"
+
+    metrics = []
+    for metric in config.metrics:
+        m = metric(num_classes=num_classes, average="macro").to(device)
+        m.__name__ = m.__class__.__name__
+        metrics.append(m)
+    # multi_jaccard = MulticlassJaccardIndex(num_classes=num_classes, average="macro").to(device)
+    # multi_jaccard.__name__ = "iou_score"
+    # metrics = [multi_jaccard]
+
+    return loss, metrics
+
+
 class TrainingPipeline:
     def __init__(self, name,  training_config, sampler=None, stratify_on=None):
         self.name = name
@@ -17,87 +141,472 @@ class TrainingPipeline:
         self.stratify_on = stratify_on
         self.sampler = sampler
         self.save_dir = f"{self.training_config.outdir}/{self.name}/"
-        
-        self.load_datasources()
         os.makedirs(self.save_dir, exist_ok=True)
 
+        self.rank, self.world_size = 0, 1
+        if self.training_config.distributed:
+            self.rank, self.world_size = init_distributed(self.training_config.dist_backend)
+            # Same initial weights and DataLoader worker seeds on every rank
+            torch.manual_seed(self.training_config.random_state)
+
+        self.load_datasources()
+
     def load_datasources(self):
+        # Loader batches are whole optimizer steps; TrainEpoch splits them into micro-batches as needed
+        self.train_batch_size = self.training_config.effective_batch_size or self.training_config.train_batch_size
         train_data = pd.read_csv(self.training_config.train_set)
         valid_data = pd.read_csv(self.training_config.valid_set)
         test_data = pd.read_csv(self.training_config.test_set)
+        self.transforms, self.collate_fn = select_transforms(self.training_config)
 
-        self.train_split = self.training_config.dataset(self.training_config.imaging_root, train_data.id, self.training_config.transforms)
-        self.valid_split = self.training_config.dataset(self.training_config.imaging_root, valid_data.id, self.training_config.transforms)
-        self.test_split = self.training_config.dataset(self.training_config.imaging_root, test_data.id, self.training_config.transforms)
+        if self.training_config.manifest is not None:
+            manifest = load_manifest(self.training_config.manifest)
+            for split, data in (("train", train_data), ("valid", valid_data), ("test", test_data)):
+                check_ids(manifest, data.id, f"{split} ids")
 
-        self.train_loader = DataLoader(self.train_split, batch_size=self.training_config.train_batch_size)
+        if self.training_config.shard_root is not None:
+            self.load_shards()
+        else:
+            self.load_splits(train_data, valid_data, test_data)
 
         if self.sampler:
+            if isinstance(self.train_split, IterableDataset):
+                raise ValueError("Stratified sampling needs a map-style dataset, not packed shards")
             print("Stratified Sampler!!")
-            self.train_loader = DataLoader(self.train_split, batch_sampler=self.sampler(train_data[self.stratify_on], self.training_config.train_batch_size))
+            batch_sampler = self.sampler(train_data[self.stratify_on], self.train_batch_size)
+            if self.world_size > 1:
+                batch_sampler = DistributedBatchSampler(batch_sampler, self.rank, self.world_size)
+            train_kwargs = {"batch_sampler": batch_sampler}
+        else:
+            train_kwargs = {"batch_size": self.rank_batch_size(self.train_batch_size),
+                            **self.loader_sampling(self.train_split, shuffle=False)}
+        train_kwargs["collate_fn"] = self.collate_fn
+
+        valid_kwargs = {"batch_size": self.rank_batch_size(self.training_config.eval_batch_size), "collate_fn": self.collate_fn,
+                        **self.loader_sampling(self.valid_split, shuffle=True)}
+
+        profile = self.training_config.loader_profile
+        if self.training_config.loader_autotune:
+            profile = self.tune_loader_profile(train_kwargs)
+
+        self.train_kwargs, self.valid_kwargs, self.profile = train_kwargs, valid_kwargs, profile
+        self.train_loader = DataLoader(self.train_split, **train_kwargs, **profile.loader_kwargs())
+        self.valid_loader = DataLoader(self.valid_split, **valid_kwargs, **profile.loader_kwargs())
+
+        self.valid_subsample_positions = None
+        self.valid_subsample_loader = None
+        if self.training_config.valid_subsample is not None:
+            if isinstance(self.valid_split, IterableDataset):
+                raise ValueError("A validation subsample needs a map-style dataset, not packed shards")
+            self.valid_subsample_positions = stratified_subsample(valid_data, self.training_config.valid_subsample_stratify_on,
+                                                                  self.training_config.valid_subsample, self.training_config.random_state)
+            print(f"Validating on a subsample of {len(self.valid_subsample_positions)} of {len(valid_data)} ids until the final pass")
+            subsample = Subset(self.valid_split, self.valid_subsample_positions)
+            self.valid_subsample_loader = DataLoader(subsample, **{**valid_kwargs, **self.loader_sampling(subsample, shuffle=True)},
+                                                     **profile.loader_kwargs())
+
+    def rank_batch_size(self, batch_size):
+        # Batch sizes in the config are global, each rank loads its share
+        return max(1, batch_size // self.world_size)
+
+    def loader_sampling(self, dataset, shuffle):
+        """DataLoader sampling options for ``dataset``, split across ranks when training distributed."""
+        if isinstance(dataset, IterableDataset):
+            # Shards are shuffled, and split across ranks, by the dataset itself
+            return {}
+        if self.world_size > 1:
+            return {"sampler": DistributedSampler(dataset, self.world_size, self.rank, shuffle=shuffle, seed=self.training_config.random_state)}
+        return {"shuffle": True} if shuffle else {}
 
-        self.valid_loader = DataLoader(self.valid_split, batch_size=self.training_config.eval_batch_size, shuffle=True)
+    def load_splits(self, train_data, valid_data, test_data):
+        shared_cache = self.training_config.shared_cache_budget is not None
+        if shared_cache:
+            shared_sample_cache.resize(self.training_config.shared_cache_budget)
+
+        dataset_kwargs = {"cache_dir": self.training_config.cache_dir, "shared_cache": shared_cache,
+                          "pyramid_dir": self.training_config.pyramid_dir, "image_size": self.training_config.image_size}
+        self.train_split = self.training_config.dataset(self.training_config.imaging_root, train_data.id, self.transforms, **dataset_kwargs)
+        self.valid_split = self.training_config.dataset(self.training_config.imaging_root, valid_data.id, self.transforms, **dataset_kwargs)
+        self.test_split = self.training_config.dataset(self.training_config.imaging_root, test_data.id, self.transforms, **dataset_kwargs)
+        # Only the splits that are read during training get a sample cache, decoded once by rank 0 and reused by the others
+        with main_process_first(self.rank, self.world_size):
+            for split in (self.train_split, self.valid_split):
+                split.build_cache()
+
+        self.prefill_thread = None
+        if shared_cache and self.training_config.shared_cache_prefill:
+            self.prefill_thread = shared_sample_cache.prefill(self.train_split, pd.concat([train_data.id, valid_data.id]))
+
+    def load_shards(self):
+        # Shards are packed per split CSV by Code/build_shards.py, one directory per CSV name
+        shard_dirs = [os.path.join(self.training_config.shard_root, os.path.splitext(os.path.basename(split))[0])
+                      for split in (self.training_config.train_set, self.training_config.valid_set, self.training_config.test_set)]
+
+        partition = {"rank": self.rank, "world_size": self.world_size}
+        self.train_split = ShardedJointSegmentationDataset(shard_dirs[0], self.transforms, seed=self.training_config.random_state, **partition)
+        self.valid_split = ShardedJointSegmentationDataset(shard_dirs[1], self.transforms, seed=self.training_config.random_state, **partition)
+        self.test_split = ShardedJointSegmentationDataset(shard_dirs[2], self.transforms, shuffle=False)
+        self.prefill_thread = None
+
+    def load_feature_loaders(self, model, device):
+        """
+        Replace the loaders with ones over cached encoder features of the train and
+        validation splits, and return the decoder-only module to train on them.
+        """
+        if isinstance(self.train_split, IterableDataset):
+            raise ValueError("The encoder feature cache needs a map-style dataset, not packed shards")
+
+        config = self.training_config
+        with main_process_first(self.rank, self.world_size):
+            train_cache, valid_cache = [
+                EncoderFeatureCache.build(config.feature_cache_dir, split, model.encoder, config.feature_dtype,
+                                          config.eval_batch_size, self.collate_fn, device)
+                for split in (self.train_split, self.valid_split)
+            ]
+
+        # Cached rows are already batched to the model's input size
+        train_kwargs = {**self.train_kwargs, "collate_fn": None}
+        valid_kwargs = {**self.valid_kwargs, "collate_fn": None}
+        self.train_loader = DataLoader(train_cache, **train_kwargs, **self.profile.loader_kwargs())
+        self.valid_loader = DataLoader(valid_cache, **valid_kwargs, **self.profile.loader_kwargs())
+        if self.valid_subsample_positions is not None:
+            subsample = Subset(valid_cache, self.valid_subsample_positions)
+            self.valid_subsample_loader = DataLoader(subsample, **{**valid_kwargs, **self.loader_sampling(subsample, shuffle=True)},
+                                                     **self.profile.loader_kwargs())
+
+        return DecoderHead(model, train_cache.shapes, config.feature_dtype)
+
+    def tune_loader_profile(self, train_kwargs):
+        profile, results = autotune_loader(self.train_split, num_batches=self.training_config.autotune_batches, **train_kwargs)
+        print("Selected loader profile:", profile)
+
+        with open(f"{self.save_dir}/loader_profile.json", "w") as f:
+            json.dump({"selected": profile.to_dict(), "results": results}, f, indent=4)
+
+        return profile
 
 
     def run(self):
-        device = "cuda" if torch.cuda.is_available() else "cpu"
+        device = local_device(self.training_config.device or ("cuda" if torch.cuda.is_available() else "cpu"))
 
-        num_classes = self.training_config.labels.get_num_classes()
-        model = copy.deepcopy(smp.Unet(encoder_name=self.training_config.encoder_backbone, encoder_weights=self.training_config.encoder_weights, in_channels=self.training_config.in_channels,
-                        classes=num_classes, activation=self.training_config.activation).to(device))
-        model.encoder.requires_grad_ = False
-        model.decoder.requires_grad_ = False
+        model = build_unet(self.training_config, device)
+        loss, metrics = build_loss_and_metrics(self.training_config, device)
 
-        loss = self.training_config.loss_function()
-        loss.__name__=" loss"
+        optimizer = self.training_config.optimizer(trainable_parameters(model), lr=self.training_config.learning_rate)
 
-        metrics = []
-        for metric in self.training_config.metrics:
-            m = metric(num_classes=num_classes, average="macro").to(device)
-            m.__name__ = m.__class__.__name__
-            metrics.append(m)
-        # multi_jaccard = MulticlassJaccardIndex(num_classes=num_classes, average="macro").to(device)
-        # multi_jaccard.__name__ = "iou_score"
-        # metrics = [multi_jaccard]
+        # With a frozen encoder and a feature cache only the decoder runs per epoch; it shares its weights with model
+        train_model = model
+        if self.training_config.freeze_encoder and self.training_config.feature_cache_dir is not None:
+            train_model = self.load_feature_loaders(model, device)
+
+        # Compiled code shares its weights with model, which snapshots and checkpoints keep using
+        config = self.training_config
+        part = config.encoder_backbone if train_model is model else f"{config.encoder_backbone}-decoder"
+        train_model = compile_model(train_model, config.compile_mode, config.compile_cache_dir,
+                                    artifact_key(part, (config.in_channels, config.image_size, config.image_size), config.precision))
 
-        optimizer = self.training_config.optimizer(model.parameters(), lr=self.training_config.learning_rate)
+        # Validation runs the module itself, only training needs the gradient all-reduce
+        valid_model = train_model
+        if self.world_size > 1:
+            train_model = DistributedDataParallel(train_model, device_ids=[device] if torch.device(device).type == "cuda" else None)
 
         # create epoch runners
         # it is a simple loop of iterating over dataloader`s samples
-        train_epoch = smp.utils.train.TrainEpoch(
-            model,
+        train_epoch = TrainEpoch(
+            train_model,
             loss=loss,
             metrics=metrics,
             optimizer=optimizer,
             device=device,
-            verbose=True,
+            verbose=self.rank == 0,
+            precision=self.training_config.precision,
+            micro_batch_size=micro_batch_size(self.training_config),
+            memory_budget=self.training_config.memory_budget,
         )
 
-        valid_epoch = smp.utils.train.ValidEpoch(
-            model,
+        valid_epoch = ValidEpoch(
+            valid_model,
             loss=loss,
             metrics=metrics,
             device=device,
-            verbose=True,
+            verbose=self.rank == 0,
+            precision=self.training_config.precision,
         )
 
-        max_score = 0
+        progress = new_progress()
+        best_state = StateSnapshot()
+        checkpoint_path = f"{self.save_dir}/checkpoint.pt"
+        if config.resume and os.path.exists(checkpoint_path):
+            progress = restore_checkpoint(load_training_checkpoint(checkpoint_path), model, optimizer, train_epoch.scaler, best_state)
+            print(f"Resuming from epoch {progress['epoch'] + 1} with best score {progress['max_score']}")
+
+        # Intermediate validations use the fixed subsample when one is configured
+        valid_loader = self.valid_subsample_loader or self.valid_loader
+        start_epoch = progress["epoch"] + 1
+        train_seconds, valid_seconds = [], []
 
         self.best_model = None
-        for i in range(1, self.training_config.epochs + 1):
+        for i in range(start_epoch, config.epochs + 1):
+            if progress["stopped"]:
+                break
 
             print('\nEpoch: {}'.format(i))
-            train_logs = train_epoch.run(self.train_loader)
-            valid_logs = valid_epoch.run(self.valid_loader)
-
-            # do something (save model, change lr, etc.)
-            if max_score < valid_logs['MulticlassJaccardIndex']:
-                max_score = valid_logs['MulticlassJaccardIndex']
-                self.best_model = copy.deepcopy(model)
-                print('Model saved!')
+            start = time.perf_counter()
+            for loader in (self.train_loader, valid_loader):
+                set_loader_epoch(loader, i)
+            with join_uneven(train_model, self.world_size):
+                train_logs = train_epoch.run(self.train_loader)
+            # Ranks that finished early are still shadowing collectives inside Join, so reduce after leaving it
+            train_logs = reduce_logs(train_logs, self.world_size)
+            train_seconds.append(time.perf_counter() - start)
+            progress["epoch"] = i
+
+            if i % config.validate_every == 0 or i == config.epochs:
+                start = time.perf_counter()
+                valid_logs = reduce_logs(valid_epoch.run(valid_loader), self.world_size)
+                valid_seconds.append(time.perf_counter() - start)
+
+                # do something (save model, change lr, etc.)
+                if record_validation(progress, i, valid_logs['MulticlassJaccardIndex'], config, best_state, model):
+                    print('Model saved!')
+                if progress["stopped"]:
+                    print(f"Early stopping, no improvement since epoch {progress['last_improvement']}")
+
+            checkpoint_every = config.checkpoint_every
+            if checkpoint_every and self.rank == 0 and (i % checkpoint_every == 0 or i == config.epochs or progress["stopped"]):
+                save_checkpoint(checkpoint_path, progress, model, optimizer, train_epoch.scaler, best_state)
+
+        # The best weights are restored into the trained model rather than kept as a second copy on the device
+        if best_state.state is not None:
+            model.load_state_dict(best_state.get())
+        else:
+            print("No validation improved on a score of 0, keeping the last model")
+        self.best_model = model
+
+        full_logs, full_seconds = None, None
+        if self.valid_subsample_loader is not None and self.best_model is not None:
+            print('\nFull validation of the best model')
+            start = time.perf_counter()
+            full_logs = reduce_logs(valid_epoch.run(self.valid_loader), self.world_size)
+            full_seconds = time.perf_counter() - start
+
+        self.report_schedule(start_epoch, progress, train_seconds, valid_seconds, full_logs, full_seconds)
+
+        if self.training_config.shared_cache_budget is not None:
+            print("Shared sample cache:", shared_sample_cache.stats())
     
+    def report_schedule(self, start_epoch, progress, train_seconds, valid_seconds, full_logs, full_seconds):
+        """
+        Write schedule.json comparing this run with the fixed schedule, a full
+        validation pass after every one of ``epochs`` epochs. Skipped epochs and
+        validations are costed at the mean measured time.
+        """
+        planned = self.training_config.epochs - start_epoch + 1
+        train_mean = float(np.mean(train_seconds)) if train_seconds else 0.0
+        full_valid = full_seconds if full_seconds is not None else (float(np.mean(valid_seconds)) if valid_seconds else 0.0)
+        actual = sum(train_seconds) + sum(valid_seconds) + (full_seconds or 0.0)
+        fixed = planned * (train_mean + full_valid)
+
+        self.schedule = {
+            "start_epoch": start_epoch,
+            "epochs_planned": planned,
+            "epochs_run": len(train_seconds),
+            "epochs_saved": planned - len(train_seconds),
+            "stopped_early": progress["stopped"],
+            "best_score": float(progress["max_score"]),
+            "validations_run": len(valid_seconds),
+            "validation_samples": len(self.valid_subsample_loader.dataset) if self.valid_subsample_loader is not None else None,
+            "full_validation": {k: float(v) for k, v in full_logs.items()} if full_logs is not None else None,
+            "train_seconds": sum(train_seconds),
+            "validation_seconds": sum(valid_seconds) + (full_seconds or 0.0),
+            "seconds": actual,
+            "fixed_schedule_seconds": fixed,
+            "seconds_saved": fixed - actual
+        }
+
+        if self.rank != 0:
+            return
+
+        with open(f"{self.save_dir}/schedule.json", "w") as f:
+            json.dump(self.schedule, f, indent=4)
+
+        print(f"Ran {len(train_seconds)} of {planned} epochs, saving {planned - len(train_seconds)} epochs "
+              f"and about {fixed - actual:.1f}s against the fixed schedule")
+
+    def save(self):
+        # Every rank holds the same weights, one copy is enough
+        if self.rank != 0:
+            return
+        save_model(self.best_model, self.save_dir, self.training_config)
+        remove_checkpoint(self.save_dir)
+
+
+class MultiModelTrainingPipeline:
+    """
+    Trains one U-Net per ``(name, training_config)`` run from a single data
+    stream. One DataLoader covers the union of the runs' train ids, another the
+    union of their validation ids. Each batch is routed to every model whose
+    split contains its samples, so the samples are decoded and transformed once
+    per epoch however many models share them. The runs must share the imaging
+    root and transforms. Like TrainingPipeline, the train stream is read in
+    split order and the validation stream is shuffled, so a run whose ids keep
+    their relative order in the union sees the batches it would see alone.
+    With ``shared_shuffle`` the train stream is shuffled instead, which no
+    longer matches separate training. Early stopping applies per run, a
+    stopped run drops out of the shared pass. Checkpoints are written to each
+    run's directory and resumed together. Stratified samplers and the settings
+    in UNSUPPORTED are rejected.
+    """
+    SHARED = ("imaging_root", "image_size", "transform_backend", "cache_dir", "pyramid_dir", "shared_cache_budget",
+              "shared_shuffle", "validate_every", "checkpoint_every", "resume")
+    # Settings of a single TrainingPipeline the shared pass has no equivalent for, with the value it implies
+    UNSUPPORTED = {"valid_subsample": None, "shard_root": None, "distributed": False, "loader_autotune": False,
+                   "feature_cache_dir": None}
+
+    def __init__(self, runs):
+        self.runs = runs
+        self.names = [name for name, _ in runs]
+        self.training_config = runs[0][1]
+        for name, config in runs:
+            for key in self.SHARED:
+                if getattr(config, key) != getattr(self.training_config, key):
+                    raise ValueError(f"{name} has a different {key} from {self.names[0]}, runs sharing a data pass must match")
+            for key, value in self.UNSUPPORTED.items():
+                if getattr(config, key) != value:
+                    raise ValueError(f"{name} sets {key}, which a shared data pass does not support; train it with TrainingPipeline")
+
+        self.save_dirs = [f"{config.outdir}/{name}/" for name, config in runs]
+        for save_dir in self.save_dirs:
+            os.makedirs(save_dir, exist_ok=True)
+
+        self.load_datasources()
+
+    def load_datasources(self):
+        train_data = [pd.read_csv(config.train_set) for _, config in self.runs]
+        valid_data = [pd.read_csv(config.valid_set) for _, config in self.runs]
+        self.transforms, self.collate_fn = select_transforms(self.training_config)
+
+        for (name, config), train, valid in zip(self.runs, train_data, valid_data):
+            if config.manifest is not None:
+                manifest = load_manifest(config.manifest)
+                check_ids(manifest, train.id, f"{name} train ids")
+                check_ids(manifest, valid.id, f"{name} valid ids")
+
+        shared_cache = self.training_config.shared_cache_budget is not None
+        if shared_cache:
+            shared_sample_cache.resize(self.training_config.shared_cache_budget)
+        self.dataset_kwargs = {"cache_dir": self.training_config.cache_dir, "shared_cache": shared_cache,
+                               "pyramid_dir": self.training_config.pyramid_dir, "image_size": self.training_config.image_size}
+
+        batch_size = self.training_config.effective_batch_size or self.training_config.train_batch_size
+        self.train_loader, self.train_membership = self.shared_loader([data.id for data in train_data], batch_size,
+                                                                      self.training_config.shared_shuffle)
+        self.valid_loader, self.valid_membership = self.shared_loader([data.id for data in valid_data], self.training_config.eval_batch_size,
+                                                                      True)
+
+        seen = sum(len(data) for data in train_data)
+        print(f"{len(self.runs)} models share {len(self.train_loader.dataset)} train samples, {seen} with separate loaders")
+
+    def shared_loader(self, ids, batch_size, shuffle):
+        union = pd.Series(pd.unique(pd.concat(ids, ignore_index=True)))
+        membership = torch.from_numpy(np.stack([union.isin(run_ids).to_numpy() for run_ids in ids]))
+
+        dataset = self.training_config.dataset(self.training_config.imaging_root, union, self.transforms, **self.dataset_kwargs)
+        dataset.build_cache()
+        loader = DataLoader(IndexedDataset(dataset), batch_size=batch_size, shuffle=shuffle, collate_fn=IndexedCollate(self.collate_fn),
+                            **self.training_config.loader_profile.loader_kwargs())
+        return loader, membership
+
+    def run(self):
+        device = self.training_config.device or ("cuda" if torch.cuda.is_available() else "cpu")
+
+        models, optimizers, train_runners, valid_runners = [], [], [], []
+        for _, config in self.runs:
+            model = build_unet(config, device)
+            loss, metrics = build_loss_and_metrics(config, device)
+            optimizer = config.optimizer(trainable_parameters(model), lr=config.learning_rate)
+
+            models.append(model)
+            optimizers.append(optimizer)
+            model = compile_model(model, config.compile_mode, config.compile_cache_dir,
+                                  artifact_key(config.encoder_backbone, (config.in_channels, config.image_size, config.image_size), config.precision))
+            train_runners.append(TrainEpoch(model, loss=loss, metrics=metrics, optimizer=optimizer, device=device,
+                                            verbose=False, precision=config.precision,
+                                            micro_batch_size=micro_batch_size(config), memory_budget=config.memory_budget))
+            valid_runners.append(ValidEpoch(model, loss=loss, metrics=metrics, device=device,
+                                            verbose=False, precision=config.precision))
+
+        train_batch_sizes = [config.effective_batch_size or config.train_batch_size for _, config in self.runs]
+        valid_batch_sizes = [config.eval_batch_size for _, config in self.runs]
+        best_states = [StateSnapshot() for _ in self.runs]
+        progress = self.resume(models, optimizers, train_runners, best_states)
+
+        validate_every = self.training_config.validate_every
+        checkpoint_every = self.training_config.checkpoint_every
+        for i in range(max(p["epoch"] for p in progress) + 1, max(config.epochs for _, config in self.runs) + 1):
+            # Runs with fewer epochs or that stopped early drop out of the shared pass
+            active = [m for m, (_, config) in enumerate(self.runs) if i <= config.epochs and not progress[m]["stopped"]]
+            if not active:
+                break
+
+            print('\nEpoch: {}'.format(i))
+            run_shared_epoch([train_runners[m] for m in active], self.train_loader, self.train_membership[active],
+                             [train_batch_sizes[m] for m in active], "train")
+            for m in active:
+                progress[m]["epoch"] = i
+
+            # Each run is validated on the shared schedule and on its own last epoch
+            validated = [m for m in active if i % validate_every == 0 or i == self.runs[m][1].epochs]
+            if validated:
+                valid_logs = run_shared_epoch([valid_runners[m] for m in validated], self.valid_loader, self.valid_membership[validated],
+                                              [valid_batch_sizes[m] for m in validated], "valid")
+                for m, logs in zip(validated, valid_logs):
+                    score = logs['MulticlassJaccardIndex']
+                    if record_validation(progress[m], i, score, self.runs[m][1], best_states[m], models[m]):
+                        print(f"{self.names[m]}: {score:.4f}, model saved!")
+                    if progress[m]["stopped"]:
+                        print(f"{self.names[m]}: early stopping, no improvement since epoch {progress[m]['last_improvement']}")
+
+            for m in active:
+                if checkpoint_every and (i % checkpoint_every == 0 or i == self.runs[m][1].epochs or progress[m]["stopped"]):
+                    save_checkpoint(f"{self.save_dirs[m]}/checkpoint.pt", progress[m], models[m], optimizers[m],
+                                    train_runners[m].scaler, best_states[m])
+
+        self.best_models = []
+        for name, model, best_state in zip(self.names, models, best_states):
+            if best_state.state is not None:
+                model.load_state_dict(best_state.get())
+            else:
+                print(f"{name}: no validation improved on a score of 0, keeping the last model")
+            self.best_models.append(model)
+
+        if self.training_config.shared_cache_budget is not None:
+            print("Shared sample cache:", shared_sample_cache.stats())
+
+    def resume(self, models, optimizers, train_runners, best_states):
+        """Progress of every run, restored from their checkpoints with ``resume`` when they were written at the same epoch."""
+        progress = [new_progress() for _ in self.runs]
+        paths = [f"{save_dir}/checkpoint.pt" for save_dir in self.save_dirs]
+        if not self.training_config.resume or not all(os.path.exists(path) for path in paths):
+            return progress
+
+        # A run is either at the latest epoch or already done; anything else is a pass that was cut short
+        checkpoints = [load_training_checkpoint(path) for path in paths]
+        epoch = max(checkpoint["epoch"] for checkpoint in checkpoints)
+        if not all(checkpoint["epoch"] in (epoch, config.epochs) or checkpoint.get("stopped", False)
+                   for checkpoint, (_, config) in zip(checkpoints, self.runs)):
+            print("The checkpoints of the shared runs were written at different epochs, starting over")
+            return progress
+
+        for m, checkpoint in enumerate(checkpoints):
+            progress[m] = restore_checkpoint(checkpoint, models[m], optimizers[m], train_runners[m].scaler, best_states[m])
+        print(f"Resuming from epoch {epoch + 1}")
+        return progress
+
     def save(self):
-        torch.save(self.best_model, f"{self.save_dir}/unet_{self.training_config.encoder_backbone}.pt")
+        for (_, config), save_dir, model in zip(self.runs, self.save_dirs, self.best_models):
+            save_model(model, save_dir, config)
+            remove_checkpoint(save_dir)
 
 
 class BiasEvaluationPipeline:
@@ -106,7 +615,13 @@ class BiasEvaluationPipeline:
         self.data = data
         self.config = config
         self.results = {}
+        self.parity = {}
         self.protected_attribute_records, self.unique_attr = self.load_protected_attribute_data()
+        self.device = self.config.device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self.store = PredictionStore(self.config.prediction_store) if self.config.prediction_store is not None else None
+
+        if self.config.manifest is not None:
+            check_ids(load_manifest(self.config.manifest), self.data.id, "evaluation ids")
     
     def load_protected_attribute_data(self):
         unique_att = self.data[self.config.protected_attributes].unique()
@@ -115,63 +630,303 @@ class BiasEvaluationPipeline:
             protected_att: self.data[self.data[self.config.protected_attributes] == protected_att].reset_index(drop=True) for protected_att in unique_att
         }, unique_att
     
-    def evaluate_attribute(self, model, attribute_data):
-        attr_ds = self.config.dataset(self.config.imaging_root, attribute_data.id, self.config.transforms)
-        attr_dl = DataLoader(attr_ds, batch_size=1)
+    def prepare_model(self, model):
+        model = model.to(self.device).eval()
+        key = artifact_key(getattr(model, "name", type(model).__name__), (model.encoder._in_channels, self.config.image_size, self.config.image_size),
+                           self.config.precision)
+        return compile_model(model, self.config.compile_mode, self.config.compile_cache_dir, key)
 
-        num_classes = self.config.labels.get_num_classes()
+    def evaluation_loader(self, ids):
+        transforms, collate_fn = select_transforms(self.config)
+        dataset = self.config.dataset(self.config.imaging_root, ids, transforms, cache_dir=self.config.cache_dir,
+                                      pyramid_dir=self.config.pyramid_dir, image_size=self.config.image_size)
+        dataset.build_cache()
+        # Pinned batches let the copy of the next batch overlap the current forward pass
+        loader_kwargs = {**self.config.loader_profile.loader_kwargs(), "pin_memory": torch.device(self.device).type == "cuda"}
+        return DataLoader(dataset, batch_size=self.config.eval_batch_size, collate_fn=collate_fn, **loader_kwargs)
 
-        device = "cuda" if torch.cuda.is_available() else "cpu"
+    def evaluation_metrics(self):
+        num_classes = self.config.labels.get_num_classes()
 
         metrics = []
         for name, metric in self.config.eval_metrics.items():
-            m = metric(num_classes=num_classes, average="macro").to(device)
+            # Metrics with a confusion-matrix equivalent are scored for the whole batch at once
+            metric = confusion_metric(metric) or metric
+            m = metric(num_classes=num_classes, average="macro").to(self.device)
             m.__name__ = name
             metrics.append(m)
+        return metrics
 
-        scores = {name: [] for name in self.config.eval_metrics.keys()}
-        for img, annot in attr_dl:
-            img = img.cuda()
-            out = model(img)
+    def image_confusions(self, model, img, annot, precision):
+        with autocast(precision, self.device):
+            out = model(img).float()
+        # Same labels as the metrics derive from the softmax, including ties
+        preds = torch.softmax(out, dim=1).argmax(dim=1)
+        return confusion_matrices(preds, annot, self.config.labels.get_num_classes()), preds
+
+    def image_scores(self, model, img, annot, metrics, precision):
+        # Scores stay per image; they are gathered on the device and copied back once per batch
+        if all(isinstance(m, ConfusionMetric) for m in metrics):
+            confusion, _ = self.image_confusions(model, img, annot, precision)
+            return torch.stack([m.from_confusion(confusion) for m in metrics]).tolist()
+
+        with autocast(precision, self.device):
+            out = model(img).float()
+        probs = torch.softmax(out, dim=1)
+        return torch.stack([torch.stack([m(probs[i:i + 1], annot[i:i + 1]) for i in range(len(img))]) for m in metrics]).tolist()
+
+    def image_predictions(self, model, img, annot, precision):
+        confusion, preds = self.image_confusions(model, img, annot, precision)
+        if not self.config.store_masks:
+            return confusion.cpu().numpy(), None
+        return confusion.cpu().numpy(), preds.to(torch.uint8).cpu().numpy()
+
+    def transform_description(self):
+        transforms, collate_fn = select_transforms(self.config)
+        transform = repr(transforms) if transforms is not None else f"{type(collate_fn).__name__}({self.config.image_size})"
+        # Pyramid levels are resized ahead of time, so they give different inputs from decoding the sources
+        pyramid = f"|pyramid={os.path.abspath(self.config.pyramid_dir)}" if self.config.pyramid_dir is not None else ""
+        return f"{self.config.dataset.__name__}|{self.config.transform_backend}|{transform}{pyramid}"
 
-            for m in metrics:
-                scores[m.__name__].append(m(torch.softmax(out, dim=1), annot.cuda()).item())
+    def source_fingerprints(self, ids):
+        # Stored predictions are only reused while the radiograph and annotation they were computed from are unchanged
+        dataset = self.config.dataset(self.config.imaging_root, ids)
+        return {str(pid): source_fingerprint(dataset, pid) for pid in ids}
 
+    def store_key(self, path, precision):
+        return self.store.model_key(resolve_checkpoint(path), self.transform_description(), precision,
+                                    self.config.labels.get_num_classes())
+
+    def predict_attribute(self, model, attribute_data, precision, key, sources):
+        model.eval()
+        ids = attribute_data.id.tolist()
+        start = 0
+        with torch.inference_mode():
+            for img, annot in prefetch_to_device(self.evaluation_loader(attribute_data.id), self.device):
+                self.store.put(key, ids[start:start + len(img)], *self.image_predictions(model, img, annot, precision),
+                               sources=sources)
+                start += len(img)
+
+    def stored_scores(self, key, attribute_data):
+        confusion = torch.from_numpy(self.store.confusions(key, attribute_data.id))
+        scores = {}
+        for m in self.evaluation_metrics():
+            if not isinstance(m, ConfusionMetric):
+                raise ValueError(f"{m.__name__} cannot be computed from stored confusion matrices")
+            scores[m.__name__] = m.from_confusion(confusion).tolist()
         return scores
 
-            
-    def evaluate_bias(self):
+    def evaluate_attribute(self, model, attribute_data, precision=None):
+        precision = self.config.precision if precision is None else precision
+        attr_dl = self.evaluation_loader(attribute_data.id)
+        metrics = self.evaluation_metrics()
+
+        model.eval()
+        scores = {name: [] for name in self.config.eval_metrics.keys()}
+        with torch.inference_mode():
+            for img, annot in prefetch_to_device(attr_dl, self.device):
+                for m, value in zip(metrics, self.image_scores(model, img, annot, metrics, precision)):
+                    scores[m.__name__].extend(value)
+
+        return scores
+
+    def parity_enabled(self):
+        return self.config.precision_parity and self.config.precision != "fp32"
+
+    def evaluate_bias(self, evaluate=None):
+        """
+        ``evaluate(model_path, records, precision)`` returns the per-image scores
+        of a model on a group; by default each model is loaded and run on each
+        group separately. BiasEvaluationSweep passes scores it already computed.
+        """
+        if evaluate is None:
+            models = {}
+
+            def model(path):
+                # Only the model in use is kept, as before
+                if path not in models:
+                    models.clear()
+                    models[path] = self.prepare_model(load_model(path))
+                return models[path]
+
+            def evaluate(path, records, precision):
+                if self.store is None:
+                    return self.evaluate_attribute(model(path), records, precision)
+
+                # Only images without stored predictions of this checkpoint and transform are run through the model
+                key = self.store_key(path, precision)
+                sources = self.source_fingerprints(records.id)
+                missing = records[records.id.isin(self.store.missing(key, records.id, sources))].reset_index(drop=True)
+                if len(missing):
+                    self.predict_attribute(model(path), missing, precision, key, sources)
+                return self.stored_scores(key, records)
+
         bias_metrics = {name:m() for name, m in self.config.bias_metrics.items()}
         for exp, model_pth in self.config.get_models().items():
             print("Evaluating", exp)
             self.results[exp] = {}
             attr_scores = {name:[] for name in self.config.eval_metrics.keys()}
+            image_scores = {name:{} for name in self.config.eval_metrics.keys()}
             if type(model_pth) is dict:
-                for attr, m in model_pth.items():
-                    model = torch.load(m)
-                    records = self.protected_attribute_records[attr]
-                    scores = self.evaluate_attribute(model, records)
-
-                    for name, value in scores.items():
-                        values =  np.array(value).mean()
-                        self.results[exp][f"{name}_{attr}"] = values
-                        attr_scores[name].append(values)
-
+                # Group models are only evaluated on their own group
+                group_models = list(model_pth.items())
             elif type(model_pth) is str:
-                model = torch.load(model_pth)
-                for attribute, records in self.protected_attribute_records.items():
-                    scores = self.evaluate_attribute(model, records)
-                    for name, value in scores.items():
-                        values =  np.array(value).mean()
-                        self.results[exp][f"{name}_{attribute}"] = values
-                        attr_scores[name].append(values)
+                group_models = [(attribute, model_pth) for attribute in self.protected_attribute_records]
             else:
                 raise TypeError
-            
+
+            for attr, path in group_models:
+                records = self.protected_attribute_records[attr]
+                scores = evaluate(path, records, self.config.precision)
+                if self.parity_enabled():
+                    self.check_parity(exp, attr, scores, evaluate(path, records, "fp32"))
+
+                for name, value in scores.items():
+                    values =  np.array(value).mean()
+                    self.results[exp][f"{name}_{attr}"] = values
+                    attr_scores[name].append(values)
+                    image_scores[name][attr] = value
+
             for name, metric in bias_metrics.items():
                 for attr, values in attr_scores.items():
                     self.results[exp][f"{attr}_{name}"] = metric.compute(np.array(values))
-            
+
+            if self.config.bootstrap_samples:
+                for name, groups in image_scores.items():
+                    uncertainty = bias_uncertainty(groups, bias_metrics, self.config.bootstrap_samples, self.config.permutation_samples,
+                                                   self.config.confidence_level, self.config.bootstrap_seed)
+                    self.results[exp].update({f"{name}_{key}": value for key, value in uncertainty.items()})
+
+    def check_parity(self, exp, attribute, scores, reference):
+        # Reduced precision must not shift the per-group numbers the bias metrics are built on
+        report = self.parity.setdefault(exp, {})
+        for name, value in scores.items():
+            ref_mean, mean = float(np.mean(reference[name])), float(np.mean(value))
+            report[f"{name}_{attribute}"] = {"fp32": ref_mean, self.config.precision: mean, "abs_diff": abs(mean - ref_mean)}
+
+            if abs(mean - ref_mean) > self.config.precision_parity_tolerance:
+                print(f"WARNING: {self.config.precision} changes {exp} {name}_{attribute} by {mean - ref_mean:+.5f} against fp32")
+
     def save(self, path):
         with open(f"{path}/{self.name}.json", "w") as f:
-            json.dump(self.results, f)
\ No newline at end of file
+            json.dump(self.results, f)
+
+        if self.parity:
+            with open(f"{path}/{self.name}_precision_parity.json", "w") as f:
+                json.dump(self.parity, f, indent=4)
+
+class BiasEvaluationSweep:
+    """
+    Evaluates several BiasEvaluationPipelines, e.g. the sex, race and age
+    configs of an anatomy, in a single pass over their test images. Every
+    batch is decoded once and run through each distinct model; a group model
+    only sees the images of its group. Models listed by several experiments or
+    pipelines, such as a shared baseline, are loaded and run once. At most
+    ``max_resident_models`` models are on the device at a time; more models
+    are evaluated in several passes, each decoding only the images its models
+    need. The per-image
+    scores are then handed to each pipeline's evaluate_bias in its own record
+    order, so the results match separate evaluate_bias runs. With a prediction
+    store, images that already have stored predictions of a model are skipped,
+    and only images some model still has to see are decoded.
+    """
+    SHARED = ("dataset", "imaging_root", "image_size", "transform_backend", "cache_dir", "pyramid_dir", "device",
+              "eval_batch_size", "eval_metrics", "prediction_store", "store_masks", "max_resident_models")
+
+    def __init__(self, pipelines):
+        self.pipelines = pipelines
+        self.pipeline = pipelines[0]
+        for pipeline in pipelines:
+            for key in self.SHARED:
+                if getattr(pipeline.config, key) != getattr(self.pipeline.config, key):
+                    raise ValueError(f"{pipeline.name} has a different {key} from {self.pipeline.name}, pipelines sharing a sweep must match")
+            if pipeline.config.labels.get_num_classes() != self.pipeline.config.labels.get_num_classes():
+                raise ValueError(f"{pipeline.name} has different labels from {self.pipeline.name}")
+
+        self.ids = pd.Series(pd.unique(pd.concat([pipeline.data.id for pipeline in pipelines], ignore_index=True)))
+        self.positions = {image_id: i for i, image_id in enumerate(self.ids)}
+        self.plan_models()
+
+    def plan_models(self):
+        # (model path, precision) -> images it has to be run on, and the pipeline whose config prepares it
+        self.needs, self.owners = {}, {}
+        for pipeline in self.pipelines:
+            precisions = [pipeline.config.precision] + (["fp32"] if pipeline.parity_enabled() else [])
+            for model_pth in pipeline.config.get_models().values():
+                if type(model_pth) is dict:
+                    group_models = model_pth.items()
+                elif type(model_pth) is str:
+                    group_models = [(attribute, model_pth) for attribute in pipeline.protected_attribute_records]
+                else:
+                    raise TypeError
+
+                for attr, path in group_models:
+                    images = [self.positions[i] for i in pipeline.protected_attribute_records[attr].id]
+                    for precision in precisions:
+                        key = (resolve_checkpoint(path), precision)
+                        self.needs.setdefault(key, torch.zeros(len(self.ids), dtype=torch.bool))[images] = True
+                        self.owners.setdefault(key, pipeline)
+
+        self.store = self.pipeline.store
+        if self.store is not None:
+            self.store_keys = {key: self.owners[key].store_key(*key) for key in self.needs}
+            self.sources = self.pipeline.source_fingerprints(self.ids)
+            for key, need in self.needs.items():
+                stored = self.store.stored_ids(self.store_keys[key], self.sources)
+                need[[i for i, image_id in enumerate(self.ids) if str(image_id) in stored]] = False
+
+    def run(self):
+        pipeline = self.pipeline
+        metrics = pipeline.evaluation_metrics()
+        names = [m.__name__ for m in metrics]
+        self.scores = {key: {name: np.full(len(self.ids), np.nan) for name in names} for key in self.needs}
+
+        needs = {key: need for key, need in self.needs.items() if need.any()}
+        paths = sorted({path for path, _ in needs})
+        size = pipeline.config.max_resident_models or max(len(paths), 1)
+        passes = [paths[i:i + size] for i in range(0, len(paths), size)]
+        print(f"Evaluating {len(paths)} models in {len(passes)} passes for {len(self.pipelines)} pipelines")
+
+        for group in passes:
+            self.evaluate_models({key: need for key, need in needs.items() if key[0] in group}, metrics, names)
+
+        for p in self.pipelines:
+            print("Results for", p.name)
+            p.evaluate_bias(self.lookup)
+
+    def evaluate_models(self, needs, metrics, names):
+        # Models of one pass are freed when it returns, before the next pass loads its own
+        pipeline = self.pipeline
+        models = {path: load_model(path) for path in sorted({path for path, _ in needs})}
+        prepared = {key: self.owners[key].prepare_model(models[key[0]]) for key in needs}
+
+        todo = torch.stack(list(needs.values())).any(dim=0).nonzero().flatten()
+        print(f"Evaluating {len(models)} models on {len(todo)} of {len(self.ids)} images")
+
+        start = 0
+        loader = pipeline.evaluation_loader(self.ids.iloc[todo.numpy()].reset_index(drop=True))
+        with torch.inference_mode():
+            for img, annot in (prefetch_to_device(loader, pipeline.device) if len(todo) else []):
+                batch = todo[start:start + len(img)]
+                start += len(img)
+                for key, need in needs.items():
+                    rows = need[batch]
+                    if not rows.any():
+                        continue
+                    positions = batch[rows].numpy()
+                    inputs = (img, annot) if rows.all() else (img[rows.to(img.device)], annot[rows.to(img.device)])
+                    if self.store is not None:
+                        self.store.put(self.store_keys[key], self.ids.iloc[positions].tolist(),
+                                       *pipeline.image_predictions(prepared[key], *inputs, key[1]), sources=self.sources)
+                        continue
+
+                    for name, value in zip(names, pipeline.image_scores(prepared[key], *inputs, metrics, key[1])):
+                        self.scores[key][name][positions] = value
+
+    def lookup(self, path, records, precision):
+        key = (resolve_checkpoint(path), precision)
+        if self.store is not None:
+            return self.pipeline.stored_scores(self.store_keys[key], records)
+
+        positions = [self.positions[i] for i in records.id]
+        return {name: values[positions].tolist() for name, values in self.scores[key].items()}
@@ -0,0 +1,134 @@
+import os
+import zlib
+import hashlib
+import sqlite3
+
+import numpy as np
+
+
+def file_digest(path, chunk_size=1 << 24):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PredictionStore:
+    """
+    SQLite store of per-image evaluation results. Every (model, image id) entry
+    holds the image's confusion matrix and, optionally, the zlib-compressed
+    argmax mask. Models are keyed by the hash of the checkpoint file together
+    with a description of the transforms, the precision and the number of
+    classes, so a retrained checkpoint or a changed transform gets a new key
+    instead of reusing stale entries. Entries of a checkpoint path whose content
+    changed are deleted when the new checkpoint is registered. Each entry also
+    records a fingerprint of the source files it was computed from, and entries
+    whose radiograph or annotation changed since count as missing.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, digest TEXT);
+            CREATE TABLE IF NOT EXISTS models (model_key TEXT PRIMARY KEY, checkpoint TEXT, checkpoint_digest TEXT,
+                                               transform TEXT, precision TEXT, num_classes INTEGER);
+            CREATE TABLE IF NOT EXISTS predictions (model_key TEXT, image_id TEXT, confusion BLOB, mask BLOB,
+                                                    height INTEGER, width INTEGER, source TEXT,
+                                                    PRIMARY KEY (model_key, image_id)) WITHOUT ROWID;
+        """)
+        # Stores written before source fingerprints existed; their entries have none and are recomputed
+        if "source" not in [row[1] for row in self.db.execute("PRAGMA table_info(predictions)")]:
+            with self.db:
+                self.db.execute("ALTER TABLE predictions ADD COLUMN source TEXT")
+        self.num_classes = dict(self.db.execute("SELECT model_key, num_classes FROM models"))
+
+    def checkpoint_digest(self, path):
+        # Hashing a checkpoint reads the whole file, so digests are reused while size and mtime are unchanged
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        row = self.db.execute("SELECT size, mtime_ns, digest FROM files WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[:2] == (stat.st_size, stat.st_mtime_ns):
+            return row[2]
+
+        digest = file_digest(path)
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", (path, stat.st_size, stat.st_mtime_ns, digest))
+        return digest
+
+    def model_key(self, checkpoint, transform, precision, num_classes):
+        checkpoint = os.path.abspath(checkpoint)
+        digest = self.checkpoint_digest(checkpoint)
+        key = hashlib.sha256(f"{digest}|{transform}|{precision}|{num_classes}".encode()).hexdigest()[:32]
+
+        with self.db:
+            stale = [k for k, in self.db.execute("SELECT model_key FROM models WHERE checkpoint = ? AND checkpoint_digest != ?",
+                                                  (checkpoint, digest))]
+            for k in stale:
+                self.db.execute("DELETE FROM predictions WHERE model_key = ?", (k,))
+                self.db.execute("DELETE FROM models WHERE model_key = ?", (k,))
+                self.num_classes.pop(k, None)
+            self.db.execute("INSERT OR IGNORE INTO models VALUES (?, ?, ?, ?, ?, ?)",
+                            (key, checkpoint, digest, transform, precision, num_classes))
+        self.num_classes[key] = num_classes
+        return key
+
+    def stored_ids(self, model_key, sources=None):
+        """Ids with an entry of ``model_key``; with ``sources`` (id -> fingerprint) only entries of unchanged files."""
+        rows = self.db.execute("SELECT image_id, source FROM predictions WHERE model_key = ?", (model_key,))
+        if sources is None:
+            return {image_id for image_id, _ in rows}
+        return {image_id for image_id, source in rows if source is not None and source == sources.get(image_id)}
+
+    def missing(self, model_key, ids, sources=None):
+        stored = self.stored_ids(model_key, sources)
+        return [image_id for image_id in ids if str(image_id) not in stored]
+
+    def put(self, model_key, ids, confusions, masks=None, sources=None):
+        rows = []
+        for i, image_id in enumerate(ids):
+            mask = None if masks is None else masks[i]
+            rows.append((model_key, str(image_id), np.ascontiguousarray(confusions[i], dtype=np.int32).tobytes(),
+                         None if mask is None else zlib.compress(np.ascontiguousarray(mask, dtype=np.uint8).tobytes()),
+                         None if mask is None else mask.shape[0], None if mask is None else mask.shape[1],
+                         None if sources is None else sources[str(image_id)]))
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def classes(self, model_key):
+        # Keys registered through another connection to the same file, e.g. by another pipeline of a sweep
+        if model_key not in self.num_classes:
+            row = self.db.execute("SELECT num_classes FROM models WHERE model_key = ?", (model_key,)).fetchone()
+            if row is None:
+                raise KeyError(f"Unknown model key {model_key}")
+            self.num_classes[model_key] = row[0]
+        return self.num_classes[model_key]
+
+    def confusions(self, model_key, ids):
+        """(N, C, C) confusion matrices of ``ids`` in order; raises KeyError for ids without an entry."""
+        num_classes = self.classes(model_key)
+        if len(ids) == 0:
+            return np.zeros((0, num_classes, num_classes), dtype=np.int32)
+
+        found = {}
+        ids = [str(image_id) for image_id in ids]
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            query = f"SELECT image_id, confusion FROM predictions WHERE model_key = ? AND image_id IN ({','.join('?' * len(chunk))})"
+            found.update(self.db.execute(query, (model_key, *chunk)))
+
+        missing = [image_id for image_id in ids if image_id not in found]
+        if missing:
+            raise KeyError(f"No stored predictions of {model_key} for {len(missing)} images, e.g. {missing[:5]}")
+        return np.stack([np.frombuffer(found[image_id], dtype=np.int32) for image_id in ids]).reshape(-1, num_classes, num_classes)
+
+    def mask(self, model_key, image_id):
+        row = self.db.execute("SELECT mask, height, width FROM predictions WHERE model_key = ? AND image_id = ?",
+                              (model_key, str(image_id))).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return np.frombuffer(zlib.decompress(row[0]), dtype=np.uint8).reshape(row[1], row[2])
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,138 @@
+import os
+import sys
+import json
+import time
+import traceback
+import multiprocessing
+import multiprocessing.connection
+from dataclasses import dataclass, field
+
+import torch
+
+
+@dataclass
+class Job:
+    """
+    One experiment run. ``target(*args, **kwargs)`` is called in a worker
+    process, so it must be a module-level function taking picklable arguments.
+    ``cores`` and ``memory`` (bytes) are the job's share of the machine.
+    ``retry_kwargs`` are added to ``kwargs`` on retries, e.g. to continue
+    from the checkpoint the failed attempt left.
+    """
+    name: str
+    target: object
+    args: tuple = ()
+    kwargs: dict = field(default_factory=dict)
+    cores: int = 1
+    memory: int = 0
+    retry_kwargs: dict = field(default_factory=dict)
+
+
+def total_memory():
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def run_job(job, log_path, attempt, gpu=None):
+    # Runs in a fresh process per attempt, so thread and device settings never leak between runs
+    os.environ["OMP_NUM_THREADS"] = str(job.cores)
+    os.environ["MKL_NUM_THREADS"] = str(job.cores)
+    if gpu is not None:
+        os.environ["CUDA_VISIBLE_DEVICES"] = str(gpu)
+    torch.set_num_threads(job.cores)
+
+    with open(log_path, "a") as log:
+        # Redirect the file descriptors too, so output from C extensions and DataLoader workers is kept
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        print(f"=== {job.name}, attempt {attempt}, {job.cores} cores" + (f", GPU {gpu}" if gpu is not None else ""), flush=True)
+
+        kwargs = {**job.kwargs, **job.retry_kwargs} if attempt > 1 else job.kwargs
+        try:
+            job.target(*job.args, **kwargs)
+        except BaseException:
+            traceback.print_exc()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(1)
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+
+def run_jobs(jobs, log_dir, max_cores=None, max_memory=None, gpus=None, retries=1):
+    """
+    Run ``jobs`` concurrently, one worker process each. A job starts once its
+    cores and memory fit in what the running jobs leave of ``max_cores`` and
+    ``max_memory``, and a free GPU when ``gpus`` is given. Failed jobs, including
+    workers killed by the OS, are retried up to ``retries`` times. Each job logs
+    to ``log_dir/<name>.log`` and the wall-clock summary is written to
+    ``log_dir/summary.json`` and returned.
+    """
+    max_cores = max_cores or os.cpu_count()
+    max_memory = max_memory or total_memory()
+    os.makedirs(log_dir, exist_ok=True)
+
+    for job in jobs:
+        if job.cores > max_cores or job.memory > max_memory:
+            raise ValueError(f"{job.name} needs {job.cores} cores and {job.memory} bytes, "
+                             f"more than the {max_cores} cores and {max_memory} bytes available")
+
+    free_cores, free_memory, free_gpus = max_cores, max_memory, list(gpus or [])
+    pending = list(jobs)
+    attempts = {job.name: 0 for job in jobs}
+    summary = {}
+    running = {}
+
+    # spawn keeps CUDA usable in the workers and gives every job a clean interpreter
+    context = multiprocessing.get_context("spawn")
+    start = time.perf_counter()
+    while pending or running:
+        for job in list(pending):
+            if job.cores > free_cores or job.memory > free_memory or (gpus and not free_gpus):
+                continue
+
+            gpu = free_gpus.pop(0) if gpus else None
+            free_cores -= job.cores
+            free_memory -= job.memory
+            attempts[job.name] += 1
+            pending.remove(job)
+
+            log_path = os.path.join(log_dir, f"{job.name}.log")
+            process = context.Process(target=run_job, args=(job, log_path, attempts[job.name], gpu), name=job.name)
+            process.start()
+            running[process.sentinel] = (process, job, gpu, log_path, time.perf_counter())
+            print(f"Started {job.name} (attempt {attempts[job.name]})")
+
+        for sentinel in multiprocessing.connection.wait(list(running)):
+            process, job, gpu, log_path, job_start = running.pop(sentinel)
+            process.join()
+            seconds = time.perf_counter() - job_start
+            free_cores += job.cores
+            free_memory += job.memory
+            if gpu is not None:
+                free_gpus.append(gpu)
+
+            ok = process.exitcode == 0
+            if not ok and attempts[job.name] <= retries:
+                print(f"{job.name} failed with exit code {process.exitcode}, retrying (see {log_path})")
+                pending.append(job)
+                continue
+
+            summary[job.name] = {"status": "ok" if ok else "failed", "exitcode": process.exitcode,
+                                 "attempts": attempts[job.name], "seconds": seconds, "log": log_path}
+            print(f"{'Finished' if ok else 'Failed'} {job.name} in {seconds:.1f}s")
+
+    summary = {"wall_seconds": time.perf_counter() - start, "jobs": {job.name: summary[job.name] for job in jobs}}
+    with open(os.path.join(log_dir, "summary.json"), "w") as f:
+        json.dump(summary, f, indent=4)
+
+    return summary
+
+
+def print_summary(summary):
+    width = max(len(name) for name in summary["jobs"])
+    for name, result in summary["jobs"].items():
+        print(f"{name:<{width}}  {result['status']:<6}  {result['attempts']}  {result['seconds']:>10.1f}s")
+
+    job_seconds = sum(result["seconds"] for result in summary["jobs"].values())
+    print(f"Wall clock {summary['wall_seconds']:.1f}s for {job_seconds:.1f}s of job time")
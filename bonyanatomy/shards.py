@@ -0,0 +1,101 @@
+import json
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+
+DEMOGRAPHIC_COLUMNS = ["P02SEX", "P02RACE", "V00AGE_GROUP"]
+
+
+def write_shards(dataset, records, outdir, shard_size=256, columns=DEMOGRAPHIC_COLUMNS, random_state=42):
+    """
+    Pack the decoded images and masks of ``records`` into uncompressed ``.npz``
+    shards of ``shard_size`` samples, along with an ``index.json`` listing every
+    shard's ids and the demographic columns. Records are shuffled once before
+    packing so that every shard is a random mix of the split.
+    """
+    os.makedirs(outdir, exist_ok=True)
+    columns = [c for c in columns if c in records.columns]
+    records = records.sample(frac=1, random_state=random_state).reset_index(drop=True)
+
+    shards = []
+    for start in range(0, len(records), shard_size):
+        chunk = records.iloc[start:start + shard_size]
+        filename = f"shard-{len(shards):05d}.npz"
+
+        arrays = {"ids": np.array([str(pid) for pid in chunk.id])}
+        for c in columns:
+            arrays[c] = chunk[c].astype(str).to_numpy()
+        for i, pid in enumerate(chunk.id):
+            arrays[f"image_{i}"], arrays[f"mask_{i}"] = dataset.decode_sample(pid)
+
+        np.savez(os.path.join(outdir, filename), **arrays)
+        shards.append({"file": filename, "ids": arrays["ids"].tolist()})
+        print(f"Wrote {outdir}/{filename} ({len(chunk)} samples)")
+
+    with open(os.path.join(outdir, "index.json"), "w") as f:
+        json.dump({"num_samples": len(records), "columns": columns, "shards": shards}, f)
+
+
+class ShardedJointSegmentationDataset(IterableDataset):
+    """
+    Streams samples from shards written by ``write_shards``, reading each shard
+    sequentially. Distributed ranks take every ``world_size``-th shard and keep
+    them on every pass, so ``len`` is the number of samples this rank yields.
+    Only the order of a rank's shards is shuffled on each pass, and its
+    DataLoader workers split them further.
+    """
+    def __init__(self, shard_dir, transforms=None, shuffle=True, seed=42, rank=0, world_size=1):
+        self.shard_dir = shard_dir
+        self.transforms = transforms
+        self.shuffle = shuffle
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+
+        with open(os.path.join(shard_dir, "index.json")) as f:
+            self.index = json.load(f)
+
+    def rank_shards(self):
+        return np.arange(len(self.index["shards"]))[self.rank::self.world_size]
+
+    def __len__(self):
+        # Together the workers of a DataLoader yield every sample of the rank once
+        return sum(len(self.index["shards"][s]["ids"]) for s in self.rank_shards())
+
+    def transform(self, image, mask):
+        if self.transforms is not None:
+            transformed = self.transforms(image=image, mask=mask)
+            image = transformed["image"]
+            mask = transformed["mask"]
+        return image, mask
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        if worker_info is None:
+            epoch_seed = self.seed + self.epoch
+        else:
+            # Every worker derives the same seed for this pass so they agree on the shard split
+            epoch_seed = worker_info.seed - worker_info.id
+        self.epoch += 1
+
+        rng = np.random.default_rng(epoch_seed)
+        shards = self.index["shards"]
+        order = self.rank_shards()
+        if self.shuffle:
+            order = rng.permutation(order)
+
+        if worker_info is not None:
+            order = order[worker_info.id::worker_info.num_workers]
+
+        for s in order:
+            with np.load(os.path.join(self.shard_dir, shards[s]["file"])) as shard:
+                for i in range(len(shards[s]["ids"])):
+                    image, mask = self.transform(shard[f"image_{i}"].astype(np.float32), shard[f"mask_{i}"])
+                    if self.transforms is None:
+                        yield torch.from_numpy(image), torch.from_numpy(mask)
+                    else:
+                        yield image.type(torch.FloatTensor), mask.long()
@@ -0,0 +1,115 @@
+import io
+import os
+import posixpath
+import zipfile
+
+
+class LocalStorage:
+    """Files in a directory on a local or mounted filesystem."""
+    def __init__(self, root):
+        self.root = root
+
+    def source(self, path):
+        # pydicom and nibabel read local files directly, which lets nibabel memory-map them
+        return os.path.join(self.root, path)
+
+    def exists(self, path):
+        return os.path.exists(os.path.join(self.root, path))
+
+    def mtime(self, path):
+        return os.stat(os.path.join(self.root, path)).st_mtime_ns
+
+    def __str__(self):
+        return str(self.root)
+
+
+class ZipStorage:
+    """
+    Members of a zip archive such as ``Sample_Dataset/knee_sample.zip``, read
+    into memory buffers without extracting. The directory holding ``Images/``
+    and ``Annotations/`` is found automatically unless ``prefix`` is given.
+    Each process opens its own handle, so DataLoader workers never share a
+    file position.
+    """
+    def __init__(self, path, prefix=None):
+        self.path = path
+        self._archive = None
+        self._pid = None
+        self.prefix = self.find_prefix() if prefix is None else prefix
+
+    def archive(self):
+        if self._archive is None or self._pid != os.getpid():
+            self._archive = zipfile.ZipFile(self.path)
+            self._pid = os.getpid()
+        return self._archive
+
+    def find_prefix(self):
+        for name in self.archive().namelist():
+            if "Images/" in name:
+                return name[:name.index("Images/")]
+        return ""
+
+    def member(self, path):
+        return posixpath.normpath(self.prefix + path.replace(os.sep, "/"))
+
+    def source(self, path):
+        return io.BytesIO(self.archive().read(self.member(path)))
+
+    def exists(self, path):
+        try:
+            self.archive().getinfo(self.member(path))
+        except KeyError:
+            return False
+        return True
+
+    def mtime(self, path):
+        # Members carry no mtime beyond the DOS timestamp, the CRC catches in-place rewrites
+        info = self.archive().getinfo(self.member(path))
+        return f"{info.date_time}:{info.CRC:08x}"
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_archive"] = None
+        state["_pid"] = None
+        return state
+
+    def __str__(self):
+        return str(self.path)
+
+
+class FsspecStorage:
+    """Files behind any fsspec URL, e.g. ``s3://bucket/Knee`` or ``zip://::site.zip``."""
+    def __init__(self, url, **storage_options):
+        try:
+            import fsspec
+        except ImportError as e:
+            raise ImportError("fsspec is required to read imaging data from a URL") from e
+
+        self.url = url
+        self.fs, self.root = fsspec.core.url_to_fs(url, **storage_options)
+
+    def full_path(self, path):
+        return posixpath.join(self.root, path.replace(os.sep, "/"))
+
+    def source(self, path):
+        return io.BytesIO(self.fs.cat_file(self.full_path(path)))
+
+    def exists(self, path):
+        return self.fs.exists(self.full_path(path))
+
+    def mtime(self, path):
+        info = self.fs.info(self.full_path(path))
+        return str(info.get("mtime", info.get("LastModified", info.get("ETag", info.get("size")))))
+
+    def __str__(self):
+        return self.url
+
+
+def get_storage(root):
+    if hasattr(root, "source"):
+        return root
+    if "://" in str(root):
+        return FsspecStorage(str(root))
+    if str(root).endswith(".zip"):
+        return ZipStorage(root)
+    return LocalStorage(root)
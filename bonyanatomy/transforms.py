@@ -0,0 +1,57 @@
+from collections import defaultdict
+
+import torch
+import torch.nn.functional as F
+
+
+def select_transforms(config):
+    """
+    Return the per-sample transforms and the DataLoader ``collate_fn`` for
+    ``config.transform_backend``, either "albumentations" or "torch".
+    """
+    if config.transform_backend == "albumentations":
+        return config.transforms, None
+
+    if config.transform_backend == "torch":
+        if config.cache_dir is not None:
+            raise ValueError("The memory-mapped cache stores transformed samples and needs the albumentations backend")
+        return None, BatchResize(config.image_size)
+
+    raise ValueError(f"Unknown transform backend {config.transform_backend}")
+
+
+def nearest_indices(src, dst):
+    # Same source index as cv2.INTER_NEAREST, computed in double precision
+    scale = 1.0 / (dst / src)
+    return torch.clamp(torch.floor(torch.arange(dst, dtype=torch.float64) * scale).long(), max=src - 1)
+
+
+class BatchResize:
+    """
+    DataLoader ``collate_fn`` for datasets built without transforms. The raw
+    decoded samples are grouped by shape and each group is resized at once,
+    bilinear ``interpolate`` for images and a nearest index gather for masks,
+    which matches ``A.Resize(image_size, image_size)`` followed by ``ToTensorV2``.
+    """
+    def __init__(self, image_size):
+        self.image_size = image_size
+
+    def __call__(self, batch):
+        size = (self.image_size, self.image_size)
+        images = torch.empty((len(batch), 1) + size, dtype=torch.float32)
+        masks = torch.empty((len(batch),) + size, dtype=torch.long)
+
+        groups = defaultdict(list)
+        for i, (image, _) in enumerate(batch):
+            groups[tuple(image.shape)].append(i)
+
+        for (height, width), idx in groups.items():
+            image = torch.stack([batch[i][0] for i in idx]).unsqueeze(1).float()
+            mask = torch.stack([batch[i][1] for i in idx])
+
+            images[idx] = F.interpolate(image, size=size, mode="bilinear", align_corners=False)
+
+            rows, cols = nearest_indices(height, size[0]), nearest_indices(width, size[1])
+            masks[idx] = mask[:, rows][:, :, cols].long()
+
+        return images, masks
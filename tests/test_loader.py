@@ -0,0 +1,88 @@
+import os
+import zipfile
+
+import cv2
+import nibabel
+import numpy as np
+import pytest
+
+from bonyanatomy.dataset import BonyAnatomyJointSegmentationDataset
+
+SAMPLE_DIR = os.path.join(os.path.dirname(__file__), os.pardir, "Sample_Dataset")
+SAMPLES = ["knee_sample.zip", "hip_sample.zip"]
+# Annotations compared per archive, decoding all of them would dominate the run
+MAX_IDS = 25
+
+
+def legacy_load_nii(nii_annot):
+    # The loader before annotations were read slice-only: get_fdata, then cv2 rotate and flip
+    nii_annot_data = nii_annot.get_fdata()
+
+    if len(nii_annot_data.shape) == 3 and nii_annot_data.shape[-1] > 1:
+        if nii_annot_data.shape[-1] == 2:
+            nii_annot_data = nii_annot_data[:, :, 1]
+        else:
+            nii_annot_data = nii_annot_data[:, :, nii_annot_data.shape[-1]//2]
+
+        nii_annot_data = np.expand_dims(nii_annot_data, axis=-1)
+
+    nii_annot_data = cv2.rotate(nii_annot_data, cv2.ROTATE_90_CLOCKWISE)
+    nii_annot_data = cv2.flip(nii_annot_data, 1)
+    return nii_annot_data
+
+
+def sample_archive(name):
+    # Without git lfs the archives are small pointer files
+    path = os.path.join(SAMPLE_DIR, name)
+    if not zipfile.is_zipfile(path):
+        pytest.skip(f"{name} is not checked out, run git lfs pull")
+    return path
+
+
+def annotated_ids(dataset):
+    names = dataset.storage.archive().namelist()
+    ids = sorted(os.path.basename(name)[:-len(".nii.gz")] for name in names
+                 if "Annotations/" in name and name.endswith(".nii.gz"))
+    return ids[:MAX_IDS]
+
+
+def assert_same_mask(new, old):
+    assert new.shape == old.shape
+    assert new.dtype == np.uint8
+    np.testing.assert_array_equal(new, old.astype(np.uint8))
+
+
+@pytest.mark.parametrize("name", SAMPLES)
+def test_load_nii_matches_legacy_decode(name):
+    dataset = BonyAnatomyJointSegmentationDataset(sample_archive(name), [])
+    ids = annotated_ids(dataset)
+    assert ids
+
+    for pid in ids:
+        path = dataset.get_annotation_path(pid)
+        new = dataset.load_nii(dataset.get_file_path(path))
+        old = legacy_load_nii(dataset.read_nii(dataset.get_file_path(path)))
+        assert_same_mask(new, old)
+
+
+@pytest.mark.parametrize("name", SAMPLES)
+def test_samples_match_legacy_decode(name):
+    dataset = BonyAnatomyJointSegmentationDataset(sample_archive(name), [])
+    dataset.pids = [pid for pid in annotated_ids(dataset) if dataset.storage.exists(dataset.get_image_path(pid))]
+    assert dataset.pids
+
+    for idx, pid in enumerate(dataset.pids):
+        image, mask = dataset[idx]
+        old = legacy_load_nii(dataset.read_nii(dataset.get_file_path(dataset.get_annotation_path(pid))))
+        assert_same_mask(mask.numpy(), old)
+        assert image.shape == mask.shape
+
+
+@pytest.mark.parametrize("shape", [(6, 4), (6, 4, 1), (6, 4, 2), (6, 4, 3)])
+def test_load_nii_matches_legacy_decode_synthetic(tmp_path, shape):
+    data = np.random.default_rng(0).integers(0, 5, size=shape).astype(np.uint8)
+    path = str(tmp_path / "annotation.nii.gz")
+    nibabel.save(nibabel.Nifti1Image(data, np.eye(4)), path)
+
+    dataset = BonyAnatomyJointSegmentationDataset(str(tmp_path), [])
+    assert_same_mask(dataset.load_nii(path), legacy_load_nii(nibabel.load(path)))
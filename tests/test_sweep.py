@@ -0,0 +1,144 @@
+import json
+import os
+import sys
+
+import albumentations as A
+import nibabel
+import numpy as np
+import pandas as pd
+import pydicom
+import segmentation_models_pytorch as smp
+import torch
+from albumentations.pytorch import ToTensorV2
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "Code"))
+
+from config import BiasEvalBaseConfig
+from bonyanatomy.checkpoint import save_unet
+from bonyanatomy.labels import KneeAnatomy
+from bonyanatomy.pipeline import BiasEvaluationPipeline, BiasEvaluationSweep
+
+IMAGE_SIZE = 32
+IDS = list(range(1, 9))
+
+
+def write_sample(root, pid, rng):
+    meta = FileMetaDataset()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.1.1"
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.Rows, ds.Columns = 40, 36
+    ds.BitsAllocated, ds.BitsStored, ds.HighBit = 16, 12, 11
+    ds.PixelRepresentation, ds.SamplesPerPixel = 0, 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.PixelData = rng.integers(0, 4095, size=(40, 36), dtype=np.uint16).tobytes()
+    ds.save_as(os.path.join(root, "Images", f"{pid}.dcm"), enforce_file_format=True)
+
+    # Annotations are stored transposed relative to the radiograph
+    mask = rng.integers(0, KneeAnatomy().get_num_classes(), size=(36, 40, 1), dtype=np.uint8)
+    nibabel.save(nibabel.Nifti1Image(mask, np.eye(4)), os.path.join(root, "Annotations", f"{pid}.nii.gz"))
+
+
+def write_model(path, seed):
+    torch.manual_seed(seed)
+    model = smp.Unet(encoder_name="resnet18", encoder_weights=None, encoder_depth=3, decoder_channels=[16, 8, 4],
+                     in_channels=1, classes=KneeAnatomy().get_num_classes())
+    save_unet(path, model, IMAGE_SIZE)
+    return path
+
+
+class SyntheticGroups(BiasEvalBaseConfig):
+    image_size = IMAGE_SIZE
+    transforms = A.Compose([A.Resize(IMAGE_SIZE, IMAGE_SIZE), ToTensorV2()])
+    device = "cpu"
+    eval_batch_size = 4
+    bootstrap_samples = None
+
+    def __init__(self, root, protected_attributes, models, prediction_store=None):
+        super().__init__()
+        self.imaging_root = root
+        self.labels = KneeAnatomy()
+        self.protected_attributes = protected_attributes
+        self.models = models
+        self.prediction_store = prediction_store
+
+    def get_models(self):
+        return self.models
+
+
+def make_pipelines(tmp_path, prediction_store=None):
+    root = str(tmp_path / "Knee")
+    if not os.path.exists(root):
+        os.makedirs(os.path.join(root, "Images"))
+        os.makedirs(os.path.join(root, "Annotations"))
+        rng = np.random.default_rng(0)
+        for pid in IDS:
+            write_sample(root, pid, rng)
+        for seed in range(3):
+            write_model(str(tmp_path / f"unet_{seed}.safetensors"), seed)
+
+    models = [str(tmp_path / f"unet_{seed}.safetensors") for seed in range(3)]
+    data = pd.DataFrame({"id": IDS,
+                         "P02SEX": ["Male", "Female"] * 4,
+                         "P02RACE": ["White_Caucasian"] * 5 + ["Black_AfricanAmerican"] * 3})
+    # The second pipeline has models the first one never uses, so their store keys are registered by it
+    configs = [SyntheticGroups(root, "P02SEX", {"baseline": models[0]}, prediction_store),
+               SyntheticGroups(root, "P02RACE", {"baseline": models[0], "balanced": models[1],
+                                                 "group": {"White_Caucasian": models[2], "Black_AfricanAmerican": models[1]}},
+                               prediction_store)]
+    return [BiasEvaluationPipeline(data, f"Pipeline{i}", config) for i, config in enumerate(configs)]
+
+
+def results(pipelines):
+    return [json.dumps(pipeline.results, sort_keys=True) for pipeline in pipelines]
+
+
+def test_sweep_matches_separate_runs(tmp_path):
+    separate = make_pipelines(tmp_path)
+    for pipeline in separate:
+        pipeline.evaluate_bias()
+
+    swept = make_pipelines(tmp_path)
+    BiasEvaluationSweep(swept).run()
+    assert results(swept) == results(separate)
+
+
+def test_sweep_with_prediction_store(tmp_path):
+    separate = make_pipelines(tmp_path)
+    for pipeline in separate:
+        pipeline.evaluate_bias()
+
+    # A fresh store is filled by the sweep itself, then read back by a second sweep without running any model
+    for _ in range(2):
+        swept = make_pipelines(tmp_path, str(tmp_path / "predictions.sqlite"))
+        BiasEvaluationSweep(swept).run()
+        assert results(swept) == results(separate)
+
+
+def test_prediction_store_recomputes_changed_annotations(tmp_path):
+    store = str(tmp_path / "predictions.sqlite")
+    BiasEvaluationSweep(make_pipelines(tmp_path, store)).run()
+
+    # A corrected annotation, with a later mtime than the stored entries were computed from
+    root = str(tmp_path / "Knee")
+    path = os.path.join(root, "Annotations", f"{IDS[0]}.nii.gz")
+    write_sample(root, IDS[0], np.random.default_rng(1))
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    separate = make_pipelines(tmp_path)
+    for pipeline in separate:
+        pipeline.evaluate_bias()
+
+    swept = make_pipelines(tmp_path, store)
+    BiasEvaluationSweep(swept).run()
+    assert results(swept) == results(separate)
+
+    stored = make_pipelines(tmp_path, store)
+    for pipeline in stored:
+        pipeline.evaluate_bias()
+    assert results(stored) == results(separate)